@@ -0,0 +1,33 @@
+"""
+Runs benchmarks and writes results as JSON, to compare runs over time.
+
+    python -m benchmarks [-o results.json] [spawn pools bulk factory_dict server]
+"""
+import argparse
+import json
+import sys
+from importlib import import_module
+
+from .common import result
+
+BENCHMARKS = ('spawn', 'pools', 'bulk', 'factory_dict', 'server')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('benchmarks', nargs='*', choices=BENCHMARKS,
+                        default=BENCHMARKS)
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+
+    rv = []
+    for name in args.benchmarks:
+        print('Running %s' % name, file=sys.stderr)
+        rv.append(result(name, import_module('.' + name, __package__).run()))
+    json.dump(rv, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
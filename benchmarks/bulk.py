@@ -0,0 +1,70 @@
+"""
+EntityBulkProcessor.__call__ latency and upstream calls
+by hit ratio, concurrency and id set size.
+
+    python -m benchmarks.bulk [requests]
+"""
+import sys
+from itertools import product
+from time import perf_counter
+
+from flask_gevent import Pool
+from flask_gevent.helpers import CacheEntityBulkProcessor
+
+from .common import create_app, percentiles, report
+from .stubs import LocalCache, LocalDatabase
+
+
+class Processor(CacheEntityBulkProcessor):
+    def __init__(self, pool, cache, db, **kwargs):
+        self.db = db
+        super().__init__(pool, cache, 60, 0, **kwargs)
+
+    def _worker(self, entity_id):
+        return self.db.get(entity_id)
+
+    def _batch_worker(self, entity_ids):
+        return self.db.get_many(entity_ids)
+
+
+def bench(requests, hit_ratio, concurrency, size, **options):
+    cache, db = LocalCache(), LocalDatabase()
+    processor = Processor(Pool(100), cache, db, **options)
+    latencies = []
+
+    def request(index):
+        # Each request asks for size ids, hit_ratio of them are cached
+        offset = index * size
+        cache.update({entity_id: {'id': entity_id}
+                      for entity_id in range(offset, offset + int(size * hit_ratio))})
+        started = perf_counter()
+        processor(*range(offset, offset + size), join=True)
+        latencies.append(perf_counter() - started)
+
+    pool = Pool(concurrency)
+    started = perf_counter()
+    for index in range(requests):
+        pool.spawn(request, index)
+    pool.join()
+    return {
+        'rps': requests / (perf_counter() - started),
+        'latency': percentiles(latencies),
+        'upstream_calls': db.calls,
+    }
+
+
+def run(requests=100, hit_ratios=(0, 0.5, 0.9, 1), concurrencies=(1, 10, 100),
+        sizes=(10, 100, 1000)):
+    app = create_app()
+    results = {}
+    with app.app_context():
+        for hit_ratio, concurrency, size in product(hit_ratios, concurrencies, sizes):
+            for mode, options in (('single', {}), ('batch', {'batch_size': 100})):
+                key = 'hit=%s,concurrency=%s,size=%s,%s' % (
+                    hit_ratio, concurrency, size, mode)
+                results[key] = bench(requests, hit_ratio, concurrency, size, **options)
+    return results
+
+
+if __name__ == '__main__':
+    report('bulk', run(*map(int, sys.argv[1:])))
@@ -0,0 +1,55 @@
+import json
+import platform
+import sys
+from importlib.metadata import version
+from time import perf_counter, time
+
+from flask import Flask
+
+from flask_gevent import Gevent
+
+
+def create_app(**config):
+    app = Flask('benchmarks')
+    app.config.update(config)
+    Gevent(app)
+    return app
+
+
+def measure(func, number, repeat=5):
+    # Returns best and median seconds per call of func(number) over repeats,
+    # func should do number operations itself to avoid call overhead
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        func(number)
+        timings.append((perf_counter() - started) / number)
+    timings.sort()
+    return {'number': number, 'best': timings[0], 'median': timings[len(timings) // 2]}
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'p%s' % point: values[min(len(values) - 1, len(values) * point // 100)]
+        for point in points
+    }
+
+
+def result(name, results):
+    return {
+        'benchmark': name,
+        'time': time(),
+        'python': platform.python_version(),
+        'gevent': version('gevent'),
+        'flask': version('flask'),
+        'results': results,
+    }
+
+
+def report(name, results, file=None):
+    file = file or sys.stdout
+    json.dump(result(name, results), file, indent=2)
+    file.write('\n')
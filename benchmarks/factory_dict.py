@@ -0,0 +1,47 @@
+"""
+LockedFactoryDict reads under contention of concurrent greenlets.
+
+    python -m benchmarks.factory_dict [number]
+"""
+import sys
+from time import perf_counter
+
+import gevent
+
+from flask_gevent.helpers import LockedFactoryDict
+
+from .common import percentiles, report
+
+
+def bench(number, concurrency, keys, factory_latency=0.001):
+    def factory(key):
+        gevent.sleep(factory_latency)
+        return key
+
+    data = LockedFactoryDict(factory, timeout=10)
+    latencies = []
+
+    def reader(index):
+        for i in range(number // concurrency):
+            started = perf_counter()
+            data[(index + i) % keys]
+            latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+    gevent.joinall([gevent.spawn(reader, index) for index in range(concurrency)])
+    return {
+        'reads_per_second': len(latencies) / (perf_counter() - started),
+        'latency': percentiles(latencies),
+    }
+
+
+def run(number=100000, concurrencies=(1, 10, 100, 1000), keys=(1, 100, 10000)):
+    return {
+        'concurrency=%s,keys=%s' % (concurrency, key_count):
+            bench(number, concurrency, key_count)
+        for concurrency in concurrencies for key_count in keys
+    }
+
+
+if __name__ == '__main__':
+    report('factory_dict', run(*map(int, sys.argv[1:])))
@@ -0,0 +1,51 @@
+"""
+Pool.spawn throughput and spawn-to-start latency for different pool sizes.
+
+    python -m benchmarks.pools [number]
+"""
+import sys
+from time import perf_counter
+
+import gevent
+
+from flask_gevent import Pool
+
+from .common import create_app, measure, percentiles, report
+
+
+def spawn_join(pool):
+    def bench(number):
+        for _ in range(number):
+            pool.spawn(gevent.sleep, 0)
+        pool.join()
+    return bench
+
+
+def latency(pool, number):
+    # Seconds from spawn call to greenlet start, including wait for free slot
+    latencies = []
+
+    def started(spawned):
+        latencies.append(perf_counter() - spawned)
+        gevent.sleep(0)
+
+    for _ in range(number):
+        pool.spawn(started, perf_counter())
+    pool.join()
+    return percentiles(latencies)
+
+
+def run(number=10000, sizes=(10, 100, 1000, None)):
+    app = create_app()
+    results = {}
+    with app.app_context():
+        for size in sizes:
+            results['Pool(%s)' % size] = {
+                'spawn_join': measure(spawn_join(Pool(size)), number),
+                'start_latency': latency(Pool(size), number),
+            }
+    return results
+
+
+if __name__ == '__main__':
+    report('pools', run(*map(int, sys.argv[1:])))
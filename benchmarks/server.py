@@ -0,0 +1,102 @@
+"""
+End-to-end requests per second through server.serve_forever,
+server is started in subprocess and loaded with keep-alive connections.
+
+    python -m benchmarks.server [duration] [connections] [workers]
+"""
+import os
+import signal
+import subprocess
+import sys
+from time import perf_counter, sleep
+
+import gevent
+import gevent.socket
+
+from .common import create_app, percentiles, report
+
+ADDRESS = ('127.0.0.1', 18089)
+
+
+def serve(workers):
+    from flask_gevent.server import serve_forever
+
+    app = create_app(GEVENT_SERVER_LISTEN='%s:%s' % ADDRESS,
+                     GEVENT_SERVER_WORKERS=workers)
+
+    @app.route('/')
+    def index():
+        return 'Hello, World!'
+
+    serve_forever(app, log=None)
+
+
+def connect(timeout=10):
+    started = perf_counter()
+    while True:
+        try:
+            return gevent.socket.create_connection(ADDRESS)
+        except ConnectionRefusedError:
+            if perf_counter() - started > timeout:
+                raise
+            gevent.sleep(0.1)
+
+
+def client(duration, latencies, errors):
+    request = ('GET / HTTP/1.1\r\nHost: %s:%s\r\n\r\n' % ADDRESS).encode()
+    sock = connect()
+    reader = sock.makefile('rb')
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        started = perf_counter()
+        try:
+            sock.sendall(request)
+            length = 0
+            while True:
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError('Connection closed')
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+                if line == b'\r\n':
+                    break
+            reader.read(length)
+        except OSError:
+            errors.append(1)
+            sock = connect()
+            reader = sock.makefile('rb')
+            continue
+        latencies.append(perf_counter() - started)
+    sock.close()
+
+
+def run(duration=10, connections=100, workers=0):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.server', '--serve', str(workers)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    try:
+        connect().close()
+        latencies, errors = [], []
+        started = perf_counter()
+        gevent.joinall([gevent.spawn(client, duration, latencies, errors)
+                        for _ in range(connections)])
+        elapsed = perf_counter() - started
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        sleep(0.5)  # releasing address
+    return {
+        'workers=%s,connections=%s' % (workers, connections): {
+            'rps': len(latencies) / elapsed,
+            'latency': percentiles(latencies),
+            'errors': len(errors),
+        },
+    }
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(int(sys.argv[2]))
+    else:
+        report('server', run(*map(int, sys.argv[1:])))
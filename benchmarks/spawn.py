@@ -0,0 +1,45 @@
+"""
+Spawn and join cost of flask_gevent.Greenlet context modes
+compared with plain gevent.Greenlet.
+
+    python -m benchmarks.spawn [number]
+"""
+import sys
+
+import gevent
+
+import flask_gevent
+
+from .common import create_app, measure, report
+
+
+def noop():
+    pass
+
+
+def spawn_join(greenlet_class):
+    def bench(number):
+        greenlets = [greenlet_class.spawn(noop) for _ in range(number)]
+        gevent.joinall(greenlets)
+    return bench
+
+
+def greenlet_class(context):
+    return type('Greenlet', (flask_gevent.Greenlet,), {'context': context})
+
+
+def run(number=10000):
+    app = create_app()
+    results = {'gevent.Greenlet': measure(spawn_join(gevent.Greenlet), number)}
+    with app.test_request_context():
+        for context in ('app', 'request', 'shared'):
+            results['flask_gevent.Greenlet[%s]' % context] = \
+                measure(spawn_join(greenlet_class(context)), number)
+        results['Gevent.spawn'] = measure(
+            lambda number: gevent.joinall([app.extensions['gevent'].spawn(noop)
+                                           for _ in range(number)]), number)
+    return results
+
+
+if __name__ == '__main__':
+    report('spawn', run(*map(int, sys.argv[1:])))
@@ -0,0 +1,45 @@
+import gevent
+
+
+class LocalCache(dict):
+    """Stands for remote cache with get_many/set_many and optional latency."""
+    def __init__(self, latency=0):
+        self.latency = latency
+        super().__init__()
+
+    def _wait(self):
+        if self.latency:
+            gevent.sleep(self.latency)
+
+    def get(self, key):
+        self._wait()
+        return super().get(key)
+
+    def set(self, key, value, timeout=None):
+        self._wait()
+        self[key] = value
+
+    def get_many(self, *keys):
+        self._wait()
+        return [super(LocalCache, self).get(key) for key in keys]
+
+    def set_many(self, mapping, timeout=None):
+        self._wait()
+        self.update(mapping)
+
+
+class LocalDatabase:
+    """Stands for upstream, returns entity after latency."""
+    def __init__(self, latency=0.001):
+        self.latency = latency
+        self.calls = 0
+
+    def get(self, entity_id):
+        self.calls += 1
+        gevent.sleep(self.latency)
+        return {'id': entity_id}
+
+    def get_many(self, entity_ids):
+        self.calls += 1
+        gevent.sleep(self.latency)
+        return {entity_id: {'id': entity_id} for entity_id in entity_ids}
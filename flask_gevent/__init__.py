@@ -1,36 +1,127 @@
+from contextvars import copy_context
+from time import monotonic, time
+from weakref import WeakKeyDictionary
+
 import gevent
 import gevent.greenlet
 import gevent.pool
-from flask import current_app
+from flask import current_app, request, has_app_context, has_request_context
+from flask.globals import request_ctx
 from werkzeug.local import LocalProxy
+from werkzeug.utils import import_string
 
-from .utils import app_context, repr_pool_status
+from .utils import (app_context, repr_pool_status, get_origin, set_origin,
+                    RequestScope, get_request_scope, set_request_scope)
 from .lifecycle import GeventLifecycle
+from .metrics import Metrics
+from .monitor import BlockingMonitor
+from .collapse import CollapseRequests
+from .offload import ThreadPool, ProcessPool
+from .profiler import SamplingProfiler
 
 
 class Greenlet(gevent.greenlet.Greenlet):
+    # How context of spawning greenlet is propagated:
+    #   'app' - new app context is pushed for the same app
+    #   'request' - copy of request context is pushed if any, 'app' otherwise
+    #   'shared' - no context is pushed, greenlet runs in copy of spawning
+    #     greenlet contextvars, so app context (and g) are shared,
+    #     spawning greenlet should outlive this one, 'app' if no app context
+    context = 'app'
     _app = current_app
 
     def __init__(self, run=None, *args, **kwargs):
         super().__init__(run, *args, **kwargs)
-        self._run = app_context(self._app)(self._run)
+        self.spawn_origin = get_origin()
+        # Deadline of request, greenlet is cancelled with it only if owned,
+        # see Gevent.spawn
+        self.request_scope = get_request_scope()
+        if self.context == 'shared' and has_app_context():
+            self.gr_context = copy_context()
+            return
+        if self.context == 'request' and has_request_context():
+            self._target, self._run = self._run, self._run_in_request_context
+            self._request_context = request_ctx.copy()
+            return
+        self.app = self._app
+        if isinstance(self.app, LocalProxy):
+            self.app = self.app._get_current_object()
+        self._target, self._run = self._run, self._run_in_app_context
+
+    def _run_in_app_context(self, *args, **kwargs):
+        with self.app.app_context():
+            return self._target(*args, **kwargs)
+
+    def _run_in_request_context(self, *args, **kwargs):
+        with self._request_context:
+            return self._target(*args, **kwargs)
+
+
+class _MetricsMixin:
+    # Records spawned and failed greenlets, in-flight count and peak,
+    # wait for free slot (Pool only) and run time histograms
+    def __init__(self, *args, **kwargs):
+        self.metrics = Metrics(('spawned', 'errors'), ('in_flight', 'peak'),
+                               ('wait', 'run'))
+        self._added = {}  # greenlet -> added time
+        # spawning greenlet -> (wait_available time, loop time), to add it
+        # to wait on spawn
+        self._waited = WeakKeyDictionary()
+        super().__init__(*args, **kwargs)
 
+    def wait_available(self, *args, **kwargs):
+        started = monotonic()
+        rv = super().wait_available(*args, **kwargs)
+        self._waited[gevent.getcurrent()] = (monotonic() - started,
+                                             gevent.get_hub().loop.now())
+        return rv
 
-class Group(gevent.pool.Group):
+    def add(self, greenlet, *args, **kwargs):
+        started = monotonic()
+        # Wait is of this spawn only if greenlet hasn't switched since then,
+        # e.g. it's not spawned after wait as other greenlet did it meanwhile
+        waited, loop_time = self._waited.pop(gevent.getcurrent(), (0, None))
+        if loop_time != gevent.get_hub().loop.now():
+            waited = 0
+        super().add(greenlet, *args, **kwargs)
+        self._added[greenlet] = now = monotonic()
+        self.metrics.inc('spawned')
+        self.metrics.observe('wait', now - started + waited)
+        self.metrics.set('in_flight', len(self))
+        self.metrics.set_max('peak', len(self))
+
+    def _discard(self, greenlet):
+        super()._discard(greenlet)
+        added = self._added.pop(greenlet, None)
+        if added is not None:
+            self.metrics.observe('run', monotonic() - added)
+            if greenlet.ready() and not greenlet.successful():
+                self.metrics.inc('errors')
+        self.metrics.set('in_flight', len(self))
+
+
+class Group(_MetricsMixin, gevent.pool.Group):
     greenlet_class = Greenlet
     __str__ = repr_pool_status
 
 
-class Pool(gevent.pool.Pool):
+class Pool(_MetricsMixin, gevent.pool.Pool):
     greenlet_class = Greenlet
     __str__ = repr_pool_status
 
 
 class _GeventState(object):
-    def __init__(self, gevent, pools, lifecycle):
+    def __init__(self, gevent, pools, lifecycle, monitor=None, thread_pools={},
+                 process_pools={}, collapse=None, profiler=None):
         self.gevent = gevent
         self.pools = pools
+        self.thread_pools = thread_pools
+        self.process_pools = process_pools
         self.lifecycle = lifecycle
+        self.monitor = monitor
+        self.collapse = collapse
+        self.profiler = profiler
+        self.admission = None  # set by server.serve_forever if enabled
 
     def __getattr__(self, name):
         return getattr(self.gevent, name)
@@ -54,17 +145,98 @@ class Gevent(object):
         elif options:
             raise TypeError('options passed without app')
 
-    def init_app(self, app, pools={}, **lifecycle):
+    def init_app(self, app, pools={}, monitor=None, thread_pools={},
+                 process_pools={}, collapse_requests=None, profiler=None, **lifecycle):
         pools = {
             name: (
                 pool if isinstance(pool, gevent.pool.Group)
-                else self.pool_class(**{'greenlet_class': self.greenlet_class, **pool})
+                else self._create_pool(**pool)
             )
             for name, pool in {**app.config.get('GEVENT_POOLS', {}), **pools}.items()
         }
+        # Options are passed to ThreadPool and ProcessPool, e.g. {'size': 4}
+        thread_pools = {
+            name: pool if isinstance(pool, ThreadPool) else ThreadPool(app, **pool)
+            for name, pool in {'default': {},
+                               **app.config.get('GEVENT_THREAD_POOLS', {}),
+                               **thread_pools}.items()
+        }
+        process_pools = {
+            name: pool if isinstance(pool, ProcessPool) else ProcessPool(app, **pool)
+            for name, pool in {'default': {},
+                               **app.config.get('GEVENT_PROCESS_POOLS', {}),
+                               **process_pools}.items()
+        }
         lifecycle = {**app.config.get('GEVENT_LIFECYCLE', {}), **lifecycle}
-        app.extensions['gevent'] = _GeventState(self, pools,
-                                                GeventLifecycle(app, **lifecycle))
+        monitor = app.config.get('GEVENT_MONITOR') if monitor is None else monitor
+        profiler = app.config.get('GEVENT_PROFILER') if profiler is None else profiler
+        if monitor or profiler:
+            app.before_request(self._set_request_origin)
+        if monitor:
+            # True or BlockingMonitor options
+            monitor = BlockingMonitor(app, **(monitor if monitor is not True else {}))
+            monitor.start()
+        app.before_request(self._start_request_scope)
+        app.teardown_request(self._finish_request_scope)
+        collapse_requests = app.config.get('GEVENT_COLLAPSE_REQUESTS') \
+            if collapse_requests is None else collapse_requests
+        if collapse_requests:
+            # True or CollapseRequests options
+            collapse_requests = CollapseRequests(
+                app.wsgi_app,
+                **(collapse_requests if collapse_requests is not True else {}))
+            app.wsgi_app = collapse_requests
+        lifecycle = GeventLifecycle(app, **lifecycle)
+        if profiler:
+            # True or SamplingProfiler options, 'signal' toggles profiling
+            profiler = dict(profiler if profiler is not True else {})
+            signalnum = profiler.pop('signal', None)
+            profiler = SamplingProfiler(app, **profiler)
+            if signalnum:
+                lifecycle.signal([signalnum])(profiler.toggle)
+        app.extensions['gevent'] = _GeventState(self, pools, lifecycle,
+                                                monitor or None, thread_pools,
+                                                process_pools,
+                                                collapse_requests or None,
+                                                profiler or None)
+
+    def _create_pool(self, **options):
+        # 'class' option is pool class or import string, e.g.
+        # 'flask_gevent.pools.PriorityPool'
+        pool_class = options.pop('class', self.pool_class)
+        if isinstance(pool_class, str):
+            pool_class = import_string(pool_class)
+        return pool_class(**{'greenlet_class': self.greenlet_class, **options})
+
+    @staticmethod
+    def _start_request_scope():
+        # Deadline by GEVENT_REQUEST_TIMEOUT and client header, seconds
+        scope = RequestScope()
+        timeout = current_app.config.get('GEVENT_REQUEST_TIMEOUT')
+        if timeout:
+            scope.limit(timeout)
+        header = current_app.config.get('GEVENT_REQUEST_TIMEOUT_HEADER',
+                                        'X-Request-Timeout')
+        if header and request.headers.get(header):
+            try:
+                scope.limit(float(request.headers[header]))
+            except ValueError:
+                pass
+        set_request_scope(scope)
+
+    @staticmethod
+    def _finish_request_scope(exc=None):
+        scope = get_request_scope()
+        # Teardown is called also on pop of request context copy in greenlet
+        if scope and scope.greenlet is gevent.getcurrent():
+            set_request_scope(None)
+            abandoned = isinstance(exc, (gevent.GreenletExit, gevent.Timeout)) or \
+                (scope.deadline is not None and scope.deadline <= time())
+            scope.finish(abandoned)
+
+    @staticmethod
+    def _set_request_origin():
+        set_origin('endpoint:%s' % request.endpoint)
 
     def _get_app(self):
         if current_app:
@@ -76,12 +248,32 @@ class Gevent(object):
     def app_context(self):
         return app_context(self._get_app())
 
+    def _create_greenlet(self, func, args, kwargs):
+        if not issubclass(self.greenlet_class, Greenlet):
+            return self.greenlet_class(self.app_context()(func), *args, **kwargs)
+        # Greenlet propagates context itself
+        if has_app_context():
+            return self.greenlet_class(func, *args, **kwargs)
+        with self._get_app().app_context():
+            return self.greenlet_class(func, *args, **kwargs)
+
+    def _create_owned_greenlet(self, func, args, kwargs):
+        # Spawned by request, so cancelled if request is abandoned
+        greenlet = self._create_greenlet(func, args, kwargs)
+        scope = get_request_scope()
+        if scope:
+            scope.own(greenlet)
+        return greenlet
+
     def spawn(self, func, *args, **kwargs):
-        return self.greenlet_class.spawn(self.app_context()(func), *args, **kwargs)
+        greenlet = self._create_owned_greenlet(func, args, kwargs)
+        greenlet.start()
+        return greenlet
 
     def spawn_later(self, seconds, func, *args, **kwargs):
-        return self.greenlet_class.spawn_later(seconds, self.app_context()(func),
-                                               *args, **kwargs)
+        greenlet = self._create_owned_greenlet(func, args, kwargs)
+        greenlet.start_later(seconds)
+        return greenlet
 
     def spawn_raw(self, func, *args, **kwargs):
         return gevent.spawn_raw(self.app_context()(func), *args, **kwargs)
@@ -97,6 +289,24 @@ class Gevent(object):
     def get_pool(self, name):
         return LocalProxy(lambda: self.pools[name])
 
+    def get_thread_pool(self, name):
+        return LocalProxy(
+            lambda: self._get_app().extensions['gevent'].thread_pools[name])
+
+    def get_process_pool(self, name):
+        return LocalProxy(
+            lambda: self._get_app().extensions['gevent'].process_pools[name])
+
+    def run_in_thread(self, func, *args, **kwargs):
+        # Returns AsyncResult, use get_thread_pool(name).spawn for named pool
+        return self._get_app().extensions['gevent'].thread_pools['default'] \
+            .spawn(func, *args, **kwargs)
+
+    def run_in_process(self, func, *args, **kwargs):
+        # Returns AsyncResult, use get_process_pool(name).spawn for named pool
+        return self._get_app().extensions['gevent'].process_pools['default'] \
+            .spawn(func, *args, **kwargs)
+
     @property
     def lifecycle(self):
-        self._get_app().extensions['gevent'].lifecycle
+        return self._get_app().extensions['gevent'].lifecycle
@@ -0,0 +1,121 @@
+from gevent.event import AsyncResult
+
+from .metrics import Metrics
+
+
+class _Response:
+    __slots__ = ('status', 'headers', 'body', 'environ', 'shareable')
+
+    def __init__(self, status, headers, body, environ):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.environ = environ
+        # Responses for one client only are never given to others
+        cache_control = ''
+        self.shareable = True
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                self.shareable = False
+            elif name == 'cache-control':
+                cache_control += value.lower()
+        if 'private' in cache_control or 'no-store' in cache_control:
+            self.shareable = False
+
+    def matches(self, environ):
+        # Same values of headers response varies by, as in leader request
+        for name, value in self.headers:
+            if name.lower() == 'vary':
+                for header in value.split(','):
+                    header = header.strip()
+                    if header == '*':
+                        return False
+                    key = 'HTTP_%s' % header.upper().replace('-', '_')
+                    if environ.get(key) != self.environ.get(key):
+                        return False
+        return True
+
+
+class CollapseRequests:
+    """
+    WSGI middleware running app once for concurrent identical GET and HEAD
+    requests (by method, scheme, host, path, query string and vary_headers),
+    other requests wait for it and get same buffered response.
+
+    Requests with any of bypass_headers (authenticated) are not collapsed,
+    and responses setting cookie or with Cache-Control private or no-store
+    are not shared. If request is failed or not shared, or waiting for it
+    is longer than timeout, waiting requests are running app themselves.
+    """
+    def __init__(self, app,
+                 vary_headers=('Accept', 'Accept-Encoding', 'Accept-Language'),
+                 bypass_headers=('Authorization', 'Cookie'), timeout=None):
+        self.app = app
+        self.vary_keys = tuple('HTTP_%s' % header.upper().replace('-', '_')
+                               for header in vary_headers)
+        self.bypass_keys = tuple('HTTP_%s' % header.upper().replace('-', '_')
+                                 for header in bypass_headers)
+        self.timeout = timeout
+        self.in_flight = {}  # key -> AsyncResult of _Response
+        self.metrics = Metrics(('leaders', 'collapsed', 'bypassed', 'not_shared'),
+                               ('in_flight',))
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD') or \
+                any(environ.get(key) for key in self.bypass_keys):
+            self.metrics.inc('bypassed')
+            return self.app(environ, start_response)
+
+        key = (environ['REQUEST_METHOD'], environ.get('wsgi.url_scheme'),
+               environ.get('HTTP_HOST'),
+               environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', ''),
+               environ.get('QUERY_STRING', ''),
+               *(environ.get(key) for key in self.vary_keys))
+        result = self.in_flight.get(key)
+        if result is not None:
+            # Leader failure (even if it's killed) is not raised here,
+            # only kill or timeout of this greenlet
+            result.wait(self.timeout)
+            response = result.value if result.successful() else None
+            if response and response.shareable and response.matches(environ):
+                self.metrics.inc('collapsed')
+                start_response(response.status, response.headers)
+                return [response.body]
+            self.metrics.inc('not_shared')
+            return self.app(environ, start_response)
+
+        self.metrics.inc('leaders')
+        result = self.in_flight[key] = AsyncResult()
+        self.metrics.set('in_flight', len(self.in_flight))
+        try:
+            response = self._run(environ)
+        except BaseException as exc:
+            result.set_exception(exc)
+            raise
+        else:
+            result.set(response)
+        finally:
+            del self.in_flight[key]
+            self.metrics.set('in_flight', len(self.in_flight))
+        start_response(response.status, response.headers)
+        return [response.body]
+
+    def _run(self, environ):
+        # Runs app buffering response
+        status_headers = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and status_headers:
+                raise exc_info[1].with_traceback(exc_info[2])
+            status_headers[:] = [status, headers]
+            return chunks.append
+
+        rv = self.app(environ, start_response)
+        try:
+            chunks.extend(rv)
+        finally:
+            if hasattr(rv, 'close'):
+                rv.close()
+        return _Response(*status_headers, b''.join(chunks), environ)
@@ -0,0 +1,140 @@
+import copy
+from time import monotonic
+
+from gevent import getcurrent
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from .metrics import Metrics
+from .pools import _LimitSemaphore
+
+
+class GreenletQueuePool(QueuePool):
+    """
+    QueuePool giving connections to waiting greenlets in FIFO order,
+    with checkout wait metrics.
+
+    Greenlet may pin connection (see pin), then connection is not returned
+    to pool on session close or commit, but reused by its next checkout
+    until unpin, e.g. for request life instead of checkout per transaction.
+    """
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30.0, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow,
+                         timeout=timeout, **kw)
+        # Pinned connections are counted as checked out
+        self._semaphore = max_overflow > -1 and \
+            _LimitSemaphore(pool_size + max_overflow)
+        self._pinned = {}  # greenlet -> idle connection record or None
+        self.metrics = Metrics(('checkouts', 'pinned_checkouts', 'timeouts'),
+                               ('waiting', 'pinned'), ('checkout_wait',))
+
+    @classmethod
+    def from_pool(cls, pool):
+        # recreate passes all pool options to class of pool
+        pool = copy.copy(pool)
+        pool.__class__ = cls
+        return pool.recreate()
+
+    def _do_get(self):
+        current = getcurrent()
+        record = self._pinned.get(current)
+        if record is not None:
+            self._pinned[current] = None
+            self.metrics.inc('pinned_checkouts')
+            return record
+
+        if self._semaphore:
+            started = monotonic()
+            self.metrics.set('waiting', len(self._semaphore.waiters) + 1)
+            try:
+                acquired = self._semaphore.acquire(timeout=self._timeout)
+            finally:
+                self.metrics.set('waiting', len(self._semaphore.waiters))
+            self.metrics.observe('checkout_wait', monotonic() - started)
+            if not acquired:
+                self.metrics.inc('timeouts')
+                raise exc.TimeoutError(
+                    'QueuePool limit of size %d overflow %d reached, '
+                    'connection timed out, timeout %0.2f'
+                    % (self.size(), self._max_overflow, self._timeout))
+        try:
+            record = super()._do_get()
+        except BaseException:
+            if self._semaphore:
+                self._semaphore.release()
+            raise
+        self.metrics.inc('checkouts')
+        return record
+
+    def _do_return_conn(self, record):
+        current = getcurrent()
+        if current in self._pinned and self._pinned[current] is None:
+            self._pinned[current] = record
+            return
+        self._return(record)
+
+    def _return(self, record):
+        try:
+            super()._do_return_conn(record)
+        finally:
+            if self._semaphore:
+                self._semaphore.release()
+
+    def pin(self):
+        # Next connection of current greenlet is kept until unpin
+        self._pinned.setdefault(getcurrent(), None)
+        self.metrics.set('pinned', len(self._pinned))
+
+    def unpin(self):
+        record = self._pinned.pop(getcurrent(), None)
+        self.metrics.set('pinned', len(self._pinned))
+        if record is not None:
+            self._return(record)
+
+    def status(self):
+        return '%s Pinned: %d Waiting: %d' % (
+            super().status(), len(self._pinned), self.metrics.gauges['waiting'])
+
+
+def init_sqlalchemy(app, db=None, pin_requests=True, pools=None):
+    """
+    Replaces pool of db engine with GreenletQueuePool, and warns if
+    Gevent pools are bigger than it, so greenlets would wait for checkout.
+
+    :param db: Flask-SQLAlchemy instance, of app by default
+    :param pin_requests: pin connection to request greenlet for request life
+    :param pools: names of Gevent pools using db, all by default,
+        server pool size is checked as well
+    """
+    db = db or app.extensions['sqlalchemy'].db
+    with app.app_context():
+        engine = db.engine
+    if not isinstance(engine.pool, GreenletQueuePool):
+        if not isinstance(engine.pool, QueuePool):
+            raise ValueError('QueuePool is required, got %r' % engine.pool)
+        pool, engine.pool = engine.pool, GreenletQueuePool.from_pool(engine.pool)
+        pool.dispose()
+    pool = engine.pool
+
+    if pin_requests:
+        def unpin(error):
+            pool.unpin()
+        app.before_request(pool.pin)
+        app.teardown_request(unpin)
+
+    if pool._max_overflow > -1:
+        capacity = pool.size() + pool._max_overflow
+        # Group has no size
+        sizes = {
+            name: getattr(gevent_pool, 'size', None) for name, gevent_pool
+            in app.extensions['gevent'].pools.items()
+            if pools is None or name in pools
+        }
+        sizes['server'] = app.config.get('GEVENT_SERVER_POOL_SIZE')
+        for name, size in sizes.items():
+            if size and size > capacity:
+                app.logger.warning(
+                    'Gevent pool %s of size %d is bigger than sqlalchemy pool '
+                    'size %d + overflow %d, greenlets will wait for connection',
+                    name, size, pool.size(), pool._max_overflow)
+    return pool
@@ -1,24 +1,181 @@
-from collections import UserDict
+from collections import OrderedDict, UserDict, deque, namedtuple
+from weakref import WeakSet
+from math import log
+from random import random
+from time import monotonic, time
 
 from flask import current_app
 from werkzeug.utils import cached_property
-from gevent import Timeout, joinall
-from gevent.lock import Semaphore, BoundedSemaphore
+from gevent import Greenlet, Timeout, joinall, getcurrent, sleep
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+from gevent.queue import Queue, Empty
 
-from .utils import repr_pool_status
+from .metrics import Metrics
+from .utils import (repr_pool_status, get_request_scope, set_request_scope,
+                    limit_timeout)
+
+
+class _BatchWaiter(AsyncResult):
+    # Stands for worker greenlet of single entity_id in batch mode
+    def __init__(self, entity_id):
+        super().__init__()
+        self.args = (entity_id,)
+
+    link = AsyncResult.rawlink
+
+
+class CircuitOpenError(Exception):
+    # Returned for entity_id instead of spawning worker, while circuit is open
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops spawning workers while upstream is failing: circuit is opened
+    when failed (or slower than slow_threshold) worker runs are error_rate
+    of runs within last window seconds, at least min_runs of them.
+    After open_timeout it's half-open, allowing up to probes workers,
+    and closed if all of them succeed, opened again otherwise.
+    """
+    STATES = ('closed', 'half_open', 'open')
+
+    def __init__(self, error_rate=0.5, slow_threshold=None, min_runs=10,
+                 window=30, open_timeout=10, probes=1):
+        self.error_rate = error_rate
+        self.slow_threshold = slow_threshold
+        self.min_runs = min_runs
+        self.window = window
+        self.open_timeout = open_timeout
+        self.probes = probes
+        self.state = 'closed'
+        self.opened = None  # monotonic() of open or half-open
+        self.metrics = Metrics(('rejected', 'opened'), ('state',))
+        self._runs = deque()  # (monotonic(), failed)
+        self._failures = 0
+        self._probing = 0
+        self._probed = 0
+
+    def allow(self):
+        # Returns True if worker may be spawned, it should call done then
+        if self.state != 'closed' and monotonic() - self.opened >= self.open_timeout:
+            # Probes are allowed again if previous ones are not finished in time
+            self.opened = monotonic()
+            self._set_state('half_open')
+            self._probing = self._probed = 0
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and self._probing + self._probed < self.probes:
+            self._probing += 1
+            return True
+        self.metrics.inc('rejected')
+        return False
+
+    def done(self, failed, duration=0):
+        # failed - None if worker is not finished, e.g. killed
+        if self.slow_threshold and duration > self.slow_threshold:
+            failed = True
+        if self.state == 'half_open':
+            self._probing = max(0, self._probing - 1)
+            if failed:
+                self._open()
+            elif failed is not None:
+                self._probed += 1
+                if self._probed >= self.probes:
+                    self._set_state('closed')
+                    self._runs.clear()
+                    self._failures = 0
+            return
+        if self.state != 'closed' or failed is None:
+            return
+        now = monotonic()
+        self._runs.append((now, failed))
+        self._failures += failed
+        while self._runs and self._runs[0][0] < now - self.window:
+            self._failures -= self._runs.popleft()[1]
+        if len(self._runs) >= self.min_runs and \
+                self._failures >= len(self._runs) * self.error_rate:
+            self._open()
+
+    def _open(self):
+        self.opened = monotonic()
+        self.metrics.inc('opened')
+        self._set_state('open')
+
+    def _set_state(self, state):
+        self.state = state
+        self.metrics.set('state', self.STATES.index(state))
+
+    def status(self):
+        return {
+            'state': self.state,
+            'runs': len(self._runs),
+            'failures': self._failures,
+            'rejected': self.metrics.counters['rejected'],
+            'opened': self.metrics.counters['opened'],
+        }
 
 
 class EntityBulkProcessor:
+    # All processors, for metrics views
+    instances = WeakSet()
+
     def __init__(self, pool, spawn_timeout=10, join_timeout=30,
-                 worker=None, logger=None):
+                 worker=None, logger=None,
+                 batch_size=None, batch_wait=0.01, batch_worker=None, name=None,
+                 priority=None, leases=None, lease_ttl=30, lease_poll=0.05,
+                 breaker=None):
+        # batch_size - enables batch mode, maximum entity_ids for _batch_worker
+        # batch_wait - maximum seconds to collect batch before spawning worker
+        # name - processor name in metrics, class name by default,
+        #   numbered if it's used by other instance already
+        # priority - priority class for PriorityPool, keyed by processor name
+        # leases - flask_gevent.leases.Leases shared by processes, to run worker
+        #   for entity_id in one process, others wait and use getter then
+        # lease_ttl - maximum seconds to wait for lease held by other process
+        # lease_poll - seconds between attempts to acquire lease
+        # breaker - CircuitBreaker, or True or its options, while it's open
+        #   CircuitOpenError is returned for not found entity_ids
+        if leases and batch_size:
+            raise ValueError('leases are not supported in batch mode')
+        self.name = self._get_unique_name(name)
+        self.metrics = Metrics(('hits', 'misses', 'spawns', 'join_timeouts',
+                                'lease_waits', 'lease_hits'))
+        self.instances.add(self)
         self.pool = pool
         self.spawn_timeout = spawn_timeout
         self.join_timeout = join_timeout
         if worker:
             self._worker = worker
         self._logger = logger
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.priority = priority
+        self.leases = leases
+        self.lease_ttl = lease_ttl
+        self.lease_poll = lease_poll
+        if breaker and not isinstance(breaker, CircuitBreaker):
+            breaker = CircuitBreaker(**(breaker if breaker is not True else {}))
+        self.breaker = breaker or None
+        if batch_worker:
+            self._batch_worker = batch_worker
 
         self.workers = {}
+        self._batch = []
+        self._batch_timer = None
+        self._writes = {}  # entity_id -> write buffered by _buffer_write
+        self._writes_timer = None
+
+    def _get_unique_name(self, name):
+        # Metrics and breakers are keyed by name, so it's numbered if it's
+        # used by other instance, e.g. of same class
+        names = {processor.name for processor in self.instances}
+        base = name = name or self.__class__.__name__
+        number = 1
+        while name in names:
+            number += 1
+            name = '%s_%d' % (base, number)
+        return name
 
     @cached_property
     def logger(self):
@@ -44,26 +201,9 @@ class EntityBulkProcessor:
         #   raise Exception - on_exception is triggered, traceback logged
 
         entity_ids = set(entity_ids)
-        spawn_timeout = self.spawn_timeout if spawn_timeout is None else spawn_timeout
         join_timeout = self.join_timeout if join_timeout is None else join_timeout
-
-        timeout = None
-        if spawn and spawn_timeout is not False:
-            timeout = Timeout.start_new(spawn_timeout)
-        try:
-            rv, workers = self._get_or_spawn(
-                entity_ids, spawn, link=bool(join_timeout))
-        except Timeout as exc:
-            if exc is timeout:
-                self.logger.warning('Update timeout: %s %s', exc, entity_ids)
-                if spawn_raise:
-                    raise
-                rv, workers = self._get_or_spawn(entity_ids, False, False)
-            else:
-                raise
-        finally:
-            if timeout:
-                timeout.cancel()
+        rv, workers = self._spawn_with_timeout(entity_ids, spawn, spawn_timeout,
+                                               spawn_raise, bool(join_timeout))
 
         self.logger.debug(
             'Processing: rv=%s spawned=%s pool=%s',
@@ -71,14 +211,14 @@ class EntityBulkProcessor:
             repr_pool_status(self.pool),
         )
         if workers and join:
-            if join_timeout is not None and join_raise:
-                timeout = Timeout.start_new(spawn_timeout)
-
-            finished_workers = joinall(workers, timeout=join_timeout)
+            finished_workers = joinall(workers, timeout=limit_timeout(
+                None if join_timeout is False else join_timeout))
+            self.flush()
             if len(workers) != len(finished_workers):
                 # w.args[0] is available only for not ready workers,
                 # it's cleared otherwise
                 args = [w.args for w in set(workers).difference(finished_workers)]
+                self.metrics.inc('join_timeouts')
                 self.logger.warning(
                     'Join timeout: %d, not finished workers: %s',
                     join_timeout, args)
@@ -96,15 +236,89 @@ class EntityBulkProcessor:
             return {'data': data, 'errors': errors}
         return data, errors
 
-    def _get_or_spawn(self, entity_ids, spawn, link=False):
-        rv, workers = self.getter(entity_ids), []
+    def iter(self, *entity_ids, spawn=True, spawn_timeout=None, spawn_raise=True,
+             join_timeout=None, join_raise=True):
+        # Yields (entity_id, value or exception), found by getter first,
+        # then results of workers as soon as each is finished,
+        # arguments are same as for __call__, join_timeout is overall deadline
+        entity_ids = set(entity_ids)
+        join_timeout = self.join_timeout if join_timeout is None else join_timeout
+        finished = Queue()
+
+        def link(entity_id):
+            def _link_greenlet(greenlet):
+                finished.put((entity_id, greenlet.value if greenlet.successful()
+                              else greenlet.exception))
+            return _link_greenlet
+
+        rv, workers = self._spawn_with_timeout(entity_ids, spawn, spawn_timeout,
+                                               spawn_raise, link)
+        yield from rv.items()
+
+        join_timeout = limit_timeout(None if join_timeout is False else join_timeout)
+        deadline = None if join_timeout is None else monotonic() + join_timeout
+        try:
+            for done in range(len(workers)):
+                try:
+                    entity_id, value = finished.get(timeout=None if deadline is None
+                                                    else max(0, deadline - monotonic()))
+                except Empty:
+                    self.metrics.inc('join_timeouts')
+                    self.logger.warning('Join timeout: %s, not finished workers: %d',
+                                        join_timeout, len(workers) - done)
+                    if join_raise:
+                        raise RuntimeError('Join timeout exceeded', join_timeout)
+                    return
+                if value is not None:
+                    yield entity_id, value
+        finally:
+            self.flush()
+
+    def _spawn_with_timeout(self, entity_ids, spawn, spawn_timeout, spawn_raise,
+                            link):
+        spawn_timeout = self.spawn_timeout if spawn_timeout is None else spawn_timeout
+        # Limited by remaining time of request
+        spawn_timeout = limit_timeout(None if spawn_timeout is False else spawn_timeout)
+        timeout = None
+        if spawn and spawn_timeout is not None:
+            timeout = Timeout.start_new(spawn_timeout)
+        try:
+            return self._get_or_spawn(entity_ids, spawn, link)
+        except Timeout as exc:
+            if exc is timeout:
+                self.logger.warning('Update timeout: %s %s', exc, entity_ids)
+                if spawn_raise:
+                    raise
+                return self._get_or_spawn(entity_ids, False, link)
+            raise
+        finally:
+            if timeout:
+                timeout.cancel()
+
+    def _get_or_spawn(self, entity_ids, spawn, link=False, rv=None):
+        # link - True to set worker results to rv, or function of entity_id
+        #   returning worker link
+        # rv - found values, by getter if None
+        rv, workers = self.getter(entity_ids) if rv is None else rv, []
+        scope = get_request_scope()
+        self.metrics.inc('hits', len(rv))
+        self.metrics.inc('misses', len(entity_ids) - len(rv))
         for entity_id in entity_ids.difference(rv.keys()):
             worker = self.workers.get(entity_id)
             if not worker and spawn:
+                if self.breaker and not self.breaker.allow():
+                    # Failing fast, not to hold pool slot until timeout
+                    rv[entity_id] = CircuitOpenError(self.name)
+                    continue
                 worker = self._spawn_worker(entity_id, (entity_id,))
             if worker:
+                if scope and isinstance(worker, Greenlet):
+                    # Worker is cancelled only if all requests waiting for it
+                    # are abandoned
+                    scope.own(worker)
                 if link:
-                    worker.link(self._create_link(rv, entity_id))
+                    worker.link(link(entity_id) if callable(link)
+                                else self._create_link(rv, entity_id))
                 workers.append(worker)
         return rv, workers
 
@@ -118,18 +332,89 @@ class EntityBulkProcessor:
         return _link_greenlet
 
     def _spawn_worker(self, entity_id, args=(), kwargs={}):
+        try:
+            if self.priority and hasattr(self.pool, 'priority'):
+                with self.pool.priority(self.priority, self.name):
+                    return self._spawn(entity_id, args, kwargs)
+            return self._spawn(entity_id, args, kwargs)
+        except BaseException:
+            if self.breaker:
+                self.breaker.done(None)
+            raise
+
+    def _spawn(self, entity_id, args, kwargs):
+        if self.batch_size:
+            return self._spawn_batched(entity_id)
         self.pool.wait_available()
         # For cases when several workers for same entity is waiting before spawn
-        if entity_id not in self.workers:
-            self.workers[entity_id] = self.pool.spawn(
-                self.worker, entity_id, args, kwargs)
+        if entity_id in self.workers:
+            return self._spawned_meanwhile(entity_id)
+        worker = self.workers[entity_id] = self.pool.spawn(
+            self.leased_worker if self.leases else self.worker,
+            entity_id, args, kwargs)
+        # Worker may be joined by several requests, so it's not limited by
+        # deadline of first one, but owned by each, see _get_or_spawn
+        set_request_scope(None, worker)
+        self.metrics.inc('spawns')
+        return worker
+
+    def _spawned_meanwhile(self, entity_id):
+        # Worker is spawned by other greenlet, so allowed probe is not run
+        if self.breaker:
+            self.breaker.done(None)
         return self.workers[entity_id]
 
+    def leased_worker(self, entity_id, args, kwargs):
+        # Other process may run worker for same entity_id, in this case
+        # waiting for its lease and trying getter before running worker
+        key = '%s:%s' % (self.name, entity_id)
+        deadline = monotonic() + self.lease_ttl
+        waited = False
+        try:
+            while True:
+                acquired = self.leases.acquire(key, self.lease_ttl)
+                if acquired or monotonic() >= deadline:
+                    break
+                waited = True
+                sleep(self.lease_poll)
+        except BaseException as exc:
+            self._finish_not_run(entity_id, exc)
+            raise
+        if not acquired:
+            self.logger.warning('Lease wait timeout: %s', key)
+            return self.worker(entity_id, args, kwargs)
+        try:
+            if waited:
+                self.metrics.inc('lease_waits')
+                try:
+                    rv = self.getter({entity_id})
+                except BaseException as exc:
+                    self._finish_not_run(entity_id, exc)
+                    raise
+                if entity_id in rv:
+                    self.metrics.inc('lease_hits')
+                    self._finish_not_run(entity_id)
+                    return rv[entity_id]
+            return self.worker(entity_id, args, kwargs)
+        finally:
+            # Result should be visible to other processes before release
+            self.flush()
+            self.leases.release(key)
+
+    def _finish_not_run(self, entity_id, exc=None):
+        # Worker is finished without running it, error is failure for breaker
+        del self.workers[entity_id]
+        if self.breaker:
+            self.breaker.done(True if isinstance(exc, Exception) else None)
+
     def worker(self, entity_id, args, kwargs):
         self.logger.debug('Starting worker: %s %s %s', entity_id, args, kwargs)
+        started, failed = monotonic(), None
         try:
             rv = self._worker(*args, **kwargs)
+            failed = isinstance(rv, Exception)
         except Exception as exc:
+            failed = True
             self.logger.exception('Worker failed: %s %s %s %r',
                                   entity_id, args, kwargs, exc)
             self.on_exception(entity_id, exc)
@@ -148,10 +433,122 @@ class EntityBulkProcessor:
             return rv
         finally:
             del self.workers[entity_id]
+            if self.breaker:
+                self.breaker.done(failed, monotonic() - started)
+
+    def _spawn_batched(self, entity_id):
+        if entity_id in self.workers:
+            return self._spawned_meanwhile(entity_id)
+        if len(self._batch) + 1 >= self.batch_size:
+            # Full batch is spawned by caller, so spawn_timeout is applied
+            self.pool.wait_available()
+            if entity_id in self.workers:
+                return self._spawned_meanwhile(entity_id)
+        waiter = self.workers[entity_id] = _BatchWaiter(entity_id)
+        self._batch.append(entity_id)
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+        else:
+            self._schedule_batch()
+        return waiter
+
+    def _schedule_batch(self):
+        if not self._batch_timer:
+            self._batch_timer = self._spawn_later(self.batch_wait, self._flush_batch)
+
+    def _spawn_later(self, seconds, func):
+        # Processor timer, using pool greenlet_class to spawn in current
+        # app context, but outside of request scope not to be cancelled with it
+        greenlet = self.pool.greenlet_class(func)
+        set_request_scope(None, greenlet)
+        greenlet.start_later(seconds)
+        return greenlet
+
+    def _flush_batch(self):
+        if self._batch_timer:
+            if self._batch_timer is not getcurrent():
+                self._batch_timer.kill(block=False)
+            self._batch_timer = None
+        while self._batch:
+            entity_ids = self._batch[:self.batch_size]
+            del self._batch[:self.batch_size]
+            try:
+                # Batch is shared by requests, so not cancelled with any of them
+                set_request_scope(None, self.pool.spawn(self.batch_worker, entity_ids))
+                self.metrics.inc('spawns')
+            except BaseException:
+                # Not spawned (spawn timeout), leaving it for next flush
+                self._batch[:0] = entity_ids
+                self._schedule_batch()
+                raise
+
+    def batch_worker(self, entity_ids):
+        self.logger.debug('Starting batch worker: %s', entity_ids)
+        waiters = {entity_id: self.workers[entity_id] for entity_id in entity_ids}
+        started, failed = monotonic(), dict.fromkeys(entity_ids)
+        try:
+            try:
+                rv = self._batch_worker(entity_ids)
+            except Exception as exc:
+                failed = dict.fromkeys(entity_ids, True)
+                self.logger.exception('Batch worker failed: %s %r', entity_ids, exc)
+                for entity_id in entity_ids:
+                    self.on_exception(entity_id, exc)
+                return
+            except BaseException as exc:
+                self.logger.debug('Batch worker failed: %s %r', entity_ids, exc)
+                for waiter in waiters.values():
+                    waiter.set_exception(exc)
+                raise
+            for entity_id, waiter in waiters.items():
+                value = rv.get(entity_id)
+                failed[entity_id] = isinstance(value, Exception)
+                if isinstance(value, Exception):
+                    self.logger.warning('Worker failed: %s %r', entity_id, value)
+                    self.on_exception(entity_id, value)
+                elif value is not None:
+                    self.on_value(entity_id, value)
+                waiter.set(value)
+            return rv
+        finally:
+            for entity_id, waiter in waiters.items():
+                if not waiter.ready():
+                    waiter.set(None)
+                if self.workers.get(entity_id) is waiter:
+                    del self.workers[entity_id]
+                if self.breaker:
+                    self.breaker.done(failed[entity_id], monotonic() - started)
 
     def getter(self, entity_ids):
         raise NotImplementedError()
 
+    def _buffer_write(self, entity_id, write, wait):
+        # Buffers write of on_value for _write, flushed in wait seconds at most
+        self._writes[entity_id] = write
+        if not self._writes_timer:
+            self._writes_timer = self._spawn_later(wait, self.flush)
+
+    def flush(self):
+        # Called after join, to write results buffered by on_value at once
+        if self._writes_timer:
+            if self._writes_timer is not getcurrent():
+                self._writes_timer.kill(block=False)
+            self._writes_timer = None
+        if not self._writes:
+            return
+        # Writes are kept until written to be found by getter
+        writes = dict(self._writes)
+        try:
+            self._write(writes)
+        finally:
+            for entity_id, write in writes.items():
+                if self._writes.get(entity_id) is write:
+                    del self._writes[entity_id]
+
+    def _write(self, writes):
+        # Writes buffered writes, mapping by entity_id
+        raise NotImplementedError()
+
     def on_value(self, entity_id, value):
         raise NotImplementedError()
 
@@ -161,53 +558,291 @@ class EntityBulkProcessor:
     def _worker(self, entity_id):
         raise NotImplementedError()
 
+    def _batch_worker(self, entity_ids):
+        # Returns mapping by entity_id, values are handled as _worker results
+        raise NotImplementedError()
+
+
+class LocalCache:
+    """In-process LRU cache with per-entry timeout and cache-like interface."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # key -> (value, expires)
+
+    def get(self, key):
+        try:
+            value, expires = self.data[key]
+        except KeyError:
+            return None
+        if expires and expires <= monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = (value, timeout and monotonic() + timeout)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+
+# Cached value with soft expiration time and worker duration
+CacheEntry = namedtuple('CacheEntry', 'value expires delta')
+
 
 class CacheEntityBulkProcessor(EntityBulkProcessor):
     def __init__(self, pool, cache, cache_timeout, cache_exception_timeout,
-                 **kwargs):
+                 local_cache_size=None, cache_write_wait=0.05,
+                 cache_soft_timeout=None, cache_refresh_beta=1.0, **kwargs):
+        # local_cache_size - enables in-process LRU cache in front of cache
+        # cache_write_wait - maximum seconds to buffer results for set_many,
+        #   buffer is flushed after join anyway
+        # cache_soft_timeout - enables stale-while-revalidate, values are stored
+        #   as CacheEntry and refreshed in background after this timeout,
+        #   while cache_timeout is still used as hard timeout
+        # cache_refresh_beta - probabilistic early refresh factor (XFetch),
+        #   greater values refresh earlier, 0 disables
         self.cache = cache
         self.cache_timeout = cache_timeout
         self.cache_exception_timeout = cache_exception_timeout
+        self.local_cache = local_cache_size and LocalCache(local_cache_size)
+        self.cache_write_wait = cache_write_wait
+        self.cache_soft_timeout = cache_soft_timeout
+        self.cache_refresh_beta = cache_refresh_beta
+        self._started = {}  # entity_id -> worker start time
+        self._refreshing = set()
         super().__init__(pool, **kwargs)
 
     def getter(self, entity_ids):
-        rv = {}
+        return self._get_entries(entity_ids)[0]
+
+    def _get_entries(self, entity_ids):
+        # Returns found values and stale entity_ids of them
+        rv, stale = {}, set()
+        for entity_id, data in self._get_many(entity_ids).items():
+            if isinstance(data, CacheEntry):
+                if self._is_stale(data):
+                    stale.add(entity_id)
+                data = data.value
+            rv[entity_id] = data
+        return rv, stale
+
+    def _is_stale(self, entry):
+        now = time()
+        if now >= entry.expires:
+            return True
+        if self.cache_refresh_beta and entry.delta:
+            # https://cseweb.ucsd.edu/~avattani/papers/cache_stampede.pdf
+            return (now - entry.delta * self.cache_refresh_beta
+                    * log(1 - random()) >= entry.expires)
+        return False
+
+    def _get_or_spawn(self, entity_ids, spawn, link=False):
+        rv, stale = self._get_entries(entity_ids)
+        rv, workers = super()._get_or_spawn(entity_ids, spawn, link, rv)
+        if spawn:
+            for entity_id in stale:
+                self._refresh(entity_id)
+        return rv, workers
+
+    def _refresh(self, entity_id):
+        # Not waiting for pool, stale value is returned anyway
+        if entity_id in self.workers or self.pool.full() or \
+                (self.breaker and not self.breaker.allow()):
+            return
+        self.logger.debug('Refreshing stale: %s', entity_id)
+        self._refreshing.add(entity_id)
+        self._spawn_worker(entity_id, (entity_id,))
+
+    def worker(self, entity_id, args, kwargs):
+        self._started[entity_id] = monotonic()
+        try:
+            return super().worker(entity_id, args, kwargs)
+        finally:
+            self._started.pop(entity_id, None)
+            self._refreshing.discard(entity_id)
+
+    def batch_worker(self, entity_ids):
+        started = monotonic()
+        self._started.update((entity_id, started) for entity_id in entity_ids)
+        try:
+            return super().batch_worker(entity_ids)
+        finally:
+            for entity_id in entity_ids:
+                self._started.pop(entity_id, None)
+                self._refreshing.discard(entity_id)
+
+    def _get_many(self, entity_ids):
+        rv, missing = {}, []
         for entity_id in entity_ids:
-            data = self.cache.get(entity_id)
+            if entity_id in self._writes:
+                rv[entity_id] = self._writes[entity_id][0]
+                continue
+            if self.local_cache:
+                data = self.local_cache.get(entity_id)
+                if data is not None:
+                    rv[entity_id] = data
+                    continue
+            missing.append(entity_id)
+        if not missing:
+            return rv
+
+        if hasattr(self.cache, 'get_many'):
+            values = self.cache.get_many(*missing)
+        else:
+            values = [self.cache.get(entity_id) for entity_id in missing]
+        for entity_id, data in zip(missing, values):
             if data is not None:
                 rv[entity_id] = data
+                if self.local_cache:
+                    # Remaining timeout is unknown, so it may outlive cache entry
+                    self.local_cache.set(entity_id, data, self._get_timeout(data))
         return rv
 
+    def _get_timeout(self, value):
+        if isinstance(value, Exception):
+            return self.cache_exception_timeout
+        return self.cache_timeout
+
+    def _set(self, entity_id, value):
+        timeout = self._get_timeout(value)
+        if self.cache_soft_timeout and not isinstance(value, Exception):
+            started = self._started.get(entity_id)
+            value = CacheEntry(value, time() + self.cache_soft_timeout,
+                               started and monotonic() - started)
+        if self.local_cache:
+            self.local_cache.set(entity_id, value, timeout)
+        if not hasattr(self.cache, 'set_many'):
+            return self.cache.set(entity_id, value, timeout)
+        self._buffer_write(entity_id, (value, timeout), self.cache_write_wait)
+
+    def _write(self, writes):
+        by_timeout = {}
+        for entity_id, (value, timeout) in writes.items():
+            by_timeout.setdefault(timeout, {})[entity_id] = value
+        try:
+            for timeout, mapping in by_timeout.items():
+                self.cache.set_many(mapping, timeout)
+        except Exception as exc:
+            self.logger.exception('Cache write failed: %s %r', list(writes), exc)
+
     def on_value(self, entity_id, value):
-        self.cache.set(entity_id, value, self.cache_timeout)
+        self._set(entity_id, value)
 
     def on_exception(self, entity_id, exc):
+        if entity_id in self._refreshing:
+            # Stale value is kept until hard timeout
+            return
         if self.cache_exception_timeout:
-            self.cache.set(entity_id, exc, self.cache_exception_timeout)
+            self._set(entity_id, exc)
 
     def _worker(self, entity_id):
         raise NotImplementedError()
 
 
 class SqlAlchemyEntityBulkProcessor(EntityBulkProcessor):
-    def __init__(self, pool, model, id_field='id', commit=False, **kwargs):
+    def __init__(self, pool, model, id_field='id', commit=False, upsert=False,
+                 chunk_size=500, load_only=None, commit_wait=0.05, **kwargs):
+        # commit - write values returned by worker, buffered to commit
+        #   at most chunk_size of them in one transaction, each row is
+        #   committed separately if transaction fails
+        # upsert - merge values by primary key instead of adding them
+        # chunk_size - maximum entity_ids in one IN query or transaction
+        # load_only - column names loaded by getter, all by default
+        # commit_wait - maximum seconds to buffer values before commit,
+        #   buffer is flushed after join anyway
         self.model = model
         self.id_field = id_field
         self.commit = commit
+        self.upsert = upsert
+        self.chunk_size = chunk_size
+        self.load_only = load_only
+        self.commit_wait = commit_wait
         super().__init__(pool, **kwargs)
+        self.metrics.counters.update(commits=0, commit_fallbacks=0, commit_errors=0)
 
     def getter(self, entity_ids):
-        return {
-            getattr(obj, self.id_field): obj for obj in
-            self.model.query.filter(
-                getattr(self.model, self.id_field).in_(entity_ids))
-        }
+        rv, missing = {}, []
+        for entity_id in entity_ids:
+            if entity_id in self._writes:
+                rv[entity_id] = self._writes[entity_id]
+            else:
+                missing.append(entity_id)
+        field = getattr(self.model, self.id_field)
+        query = self.model.query
+        if self.load_only:
+            from sqlalchemy.orm import load_only
+            query = query.options(load_only(field, *(
+                getattr(self.model, name) for name in self.load_only)))
+        for i in range(0, len(missing), self.chunk_size):
+            rv.update(
+                (getattr(obj, self.id_field), obj) for obj in
+                query.filter(field.in_(missing[i:i + self.chunk_size]))
+            )
+        return rv
+
+    def _write(self, writes):
+        values = list(writes.values())
+        for i in range(0, len(values), self.chunk_size):
+            self._commit(values[i:i + self.chunk_size])
+
+    def _commit(self, values):
+        try:
+            self._commit_session(values)
+            self.metrics.inc('commits')
+            return
+        except Exception as exc:
+            self.metrics.inc('commit_fallbacks')
+            self.logger.warning('Commit failed, committing by row: %d %r',
+                                len(values), exc)
+        for value in values:
+            try:
+                self._commit_session([value])
+                self.metrics.inc('commits')
+            except Exception as exc:
+                self.metrics.inc('commit_errors')
+                self.logger.exception('Commit failed: %r %r', value, exc)
+
+    def _commit_session(self, values):
+        # Own session per transaction, not to commit changes of caller and not
+        # to expire values committed already on rollback, values are not
+        # expired on commit to be usable by caller after session is closed
+        db = current_app.extensions['sqlalchemy'].db
+        session = db.session.session_factory(expire_on_commit=False)
+        try:
+            add = session.merge if self.upsert else session.add
+            for value in values:
+                add(value)
+            session.commit()
+        except Exception:
+            # Pending values are expunged and can be added again
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     def on_value(self, entity_id, value):
         if self.commit:
-            db = current_app.extensions['sqlalchemy'].db
-            db.session.add(value)
-            db.session.commit()
+            from sqlalchemy.orm import object_session
+            session = object_session(value)
+            if session is not None:
+                # Worker session may be gone until commit in other greenlet
+                session.expunge(value)
+            self._buffer_write(entity_id, value, self.commit_wait)
 
     def on_exception(self, entity_id, exc):
         pass
@@ -217,31 +852,116 @@ class SqlAlchemyEntityBulkProcessor(EntityBulkProcessor):
 
 
 class LockedFactoryDict(UserDict):
-    def __init__(self, factory=None, timeout=None):
+    def __init__(self, factory=None, timeout=None, maxsize=None, ttl=None,
+                 error_ttl=None, on_evict=None, logger=None):
+        # timeout - maximum wait for factory called by other greenlet
+        # maxsize - maximum values, least recently used are evicted
+        # ttl - seconds to keep value
+        # error_ttl - seconds to raise factory exception again without calling it
+        # on_evict - called with (key, value) on value removal, e.g. to close it
         self._factory = factory
         self.timeout = timeout
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.on_evict = on_evict
+        self._logger = logger
+        self._expires = {}
+        self._pending = {}  # key -> AsyncResult of factory call in progress
+        self._errors = OrderedDict()  # key -> (exception, expires)
         super().__init__()
+        self.data = OrderedDict()
 
-    def __getitem__(self, key):
+    @cached_property
+    def logger(self):
+        return self._logger or current_app.logger
+
+    def __contains__(self, key):
         if key not in self.data:
-            self[key] = lambda: self.factory(key)
-        return self.get(key)
+            return False
+        expires = self._expires.get(key)
+        if expires is not None and expires <= monotonic():
+            self._evict(key)
+            return False
+        return True
 
-    def get(self, key):
-        if key in self.data:
-            if isinstance(self.data[key], BoundedSemaphore):
-                self.data[key].wait(self.timeout)
-                assert not isinstance(self.data[key], BoundedSemaphore)
+    def __getitem__(self, key):
+        if key in self:
+            self.data.move_to_end(key)
+            return self.data[key]
+        if key in self._pending:
+            return self._pending[key].get(timeout=self.timeout)
+        if key in self._errors:
+            exc, expires = self._errors[key]
+            if expires > monotonic():
+                raise exc
+            del self._errors[key]
+        return self._create(key, lambda: self.factory(key))
+
+    def get(self, key, default=None):
+        if key in self:
+            self.data.move_to_end(key)
             return self.data[key]
+        if key in self._pending:
+            try:
+                return self._pending[key].get(timeout=self.timeout)
+            except Exception:
+                pass
+        return default
 
     def __setitem__(self, key, factory):
         if not callable(factory):
             raise ValueError('value %s should be callable' % factory)
-        lock = self.data[key] = BoundedSemaphore()
-        lock.acquire()
-        self.data[key] = factory()
-        assert not isinstance(self.data[key], BoundedSemaphore)
-        lock.release()
+        self._create(key, factory)
+
+    def __delitem__(self, key):
+        if key not in self.data:
+            raise KeyError(key)
+        self._evict(key)
+
+    def _create(self, key, factory):
+        # Concurrent readers of key are waiting for this result
+        result = self._pending[key] = AsyncResult()
+        try:
+            value = factory()
+        except Exception as exc:
+            if self.error_ttl:
+                self._errors[key] = (exc, monotonic() + self.error_ttl)
+                if self.maxsize is not None and len(self._errors) > self.maxsize:
+                    self._errors.popitem(last=False)
+            result.set_exception(exc)
+            raise
+        except BaseException as exc:
+            # Not raising GreenletExit or Timeout of this greenlet in readers
+            result.set_exception(RuntimeError('Factory interrupted', key, exc))
+            raise
+        else:
+            self._store(key, value)
+            result.set(value)
+            return value
+        finally:
+            if self._pending.get(key) is result:
+                del self._pending[key]
+
+    def _store(self, key, value):
+        if key in self.data and self.data[key] is not value:
+            self._evict(key)
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if self.ttl:
+            self._expires[key] = monotonic() + self.ttl
+        if self.maxsize is not None:
+            while len(self.data) > self.maxsize:
+                self._evict(next(iter(self.data)))
+
+    def _evict(self, key):
+        value = self.data.pop(key)
+        self._expires.pop(key, None)
+        if self.on_evict:
+            try:
+                self.on_evict(key, value)
+            except Exception as exc:
+                self.logger.exception('Evict failed: %s %r', key, exc)
 
     def factory(self, key):
         if self._factory is not None:
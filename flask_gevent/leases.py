@@ -0,0 +1,97 @@
+import fcntl
+import os
+import tempfile
+from hashlib import sha1
+from uuid import uuid4
+
+
+class Leases:
+    """
+    Interface of leases shared by processes, e.g. for EntityBulkProcessor
+    to run worker for entity_id in one process only.
+
+    acquire should not block, and lease should expire after ttl seconds,
+    so crashed or stuck holder is not blocking others forever.
+    Networked implementation may use e.g. redis "SET key token NX PX ttl".
+    """
+    def acquire(self, key, ttl):
+        # Returns True if lease is acquired
+        raise NotImplementedError()
+
+    def release(self, key):
+        raise NotImplementedError()
+
+    def renew(self, key, ttl):
+        # Extends lease held by us, returns False if it's lost
+        raise NotImplementedError()
+
+
+class FileLeases(Leases):
+    """
+    Leases of processes on single host, as byte-range locks of one file.
+    Lock is released by kernel when holder process exits, ttl is not used,
+    as waiters are not waiting longer than ttl anyway.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(tempfile.gettempdir(), 'flask_gevent.leases')
+        self._fd = None
+        self._held = set()
+
+    def _offset(self, key):
+        # Range locks are per process, hash collision is unlikely in 2 ** 56
+        return int.from_bytes(sha1(key.encode()).digest()[:7], 'big')
+
+    def acquire(self, key, ttl):
+        if key in self._held:
+            return False
+        if self._fd is None:
+            # Never closed, as closing any fd of file releases all process locks
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self._offset(key))
+        except OSError:
+            return False
+        self._held.add(key)
+        return True
+
+    def release(self, key):
+        if key in self._held:
+            self._held.discard(key)
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset(key))
+
+    def renew(self, key, ttl):
+        return key in self._held
+
+
+class CacheLeases(Leases):
+    """
+    Networked leases using atomic add of cache (redis, memcached),
+    expired by cache timeout. Lease holds unique token of acquire, so
+    it's released or renewed only by its holder.
+    """
+    def __init__(self, cache, prefix='lease:'):
+        self.cache = cache
+        self.prefix = prefix
+        self._tokens = {}  # key -> token of held lease
+
+    def acquire(self, key, ttl):
+        token = '%d:%s' % (os.getpid(), uuid4().hex)
+        if not self.cache.add(self.prefix + key, token, max(1, int(ttl))):
+            return False
+        self._tokens[key] = token
+        return True
+
+    def release(self, key):
+        # Not atomic, lease may expire and be acquired by other process
+        # between check and delete, but only after its ttl
+        token = self._tokens.pop(key, None)
+        if token is not None and self.cache.get(self.prefix + key) == token:
+            self.cache.delete(self.prefix + key)
+
+    def renew(self, key, ttl):
+        # Not atomic, lease may be lost if it's expired already
+        token = self._tokens.get(key)
+        if token is None or self.cache.get(self.prefix + key) != token:
+            self._tokens.pop(key, None)
+            return False
+        return bool(self.cache.set(self.prefix + key, token, max(1, int(ttl))))
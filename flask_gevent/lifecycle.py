@@ -1,12 +1,20 @@
 import atexit
 import sys
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from itertools import count
+from random import uniform
+from time import time
 
 from flask import current_app
 from werkzeug.utils import import_string
 import gevent
+import gevent.event
 import gevent.pool
 
-from .utils import app_context
+from .leases import FileLeases
+from .metrics import Metrics
+from .utils import app_context, set_origin
 
 
 def atexit_register(func):
@@ -35,7 +43,7 @@ def _maybe_import(value):
     return import_string(value) if isinstance(value, str) else value
 
 
-def _run_forever(self, sleep=0, exit_on_error=True):
+def _run_forever(sleep=0, exit_on_error=True):
     def decorator(func):
         def wrapper():
             while True:
@@ -49,14 +57,130 @@ def _run_forever(self, sleep=0, exit_on_error=True):
                 if sleep:
                     current_app.logger.debug('%s sleeping for %s seconds', func, sleep)
                     gevent.sleep(sleep)
-        return func
+        wrapper.__qualname__ = getattr(func, '__qualname__', repr(func))
+        return wrapper
     return decorator
 
 
+class _Cron:
+    # Standard 5 fields: minute hour day-of-month month day-of-week,
+    # with *, lists, ranges and steps, in local time
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('cron should have 5 fields: %s' % expr)
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, low, high)
+            for field, (low, high) in zip(fields, self.RANGES)
+        )
+        # If both are restricted, day matches any of them, as in cron
+        self.any_day = not fields[2].startswith('*') and not fields[4].startswith('*')
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+                if step:
+                    end = high
+            if not low <= start <= end <= high + (high == 6):
+                raise ValueError('cron field out of range: %s' % field)
+            values.update(value % 7 if high == 6 else value
+                          for value in range(start, end + 1, int(step or 1)))
+        return sorted(values)
+
+    def _day_matches(self, day):
+        in_days = day.day in self.days
+        in_weekdays = (day.isoweekday() % 7) in self.weekdays
+        if self.any_day:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+    def next(self, after):
+        # Next time after timestamp
+        after = datetime.fromtimestamp(after).replace(second=0, microsecond=0) \
+            + timedelta(minutes=1)
+        day = after.replace(hour=0, minute=0)
+        for _ in range(366 * 5):
+            if day.month in self.months and self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        at = day.replace(hour=hour, minute=minute)
+                        if at >= after:
+                            return at.timestamp()
+            day += timedelta(days=1)
+        raise ValueError('cron never matches: %s' % self.expr)
+
+
+class _Job:
+    def __init__(self, func, every=None, cron=None, jitter=0, overlap='skip',
+                 timeout=None, leader=False, name=None):
+        if bool(every) == bool(cron):
+            raise ValueError('one of every or cron is required')
+        if overlap not in ('skip', 'queue', 'allow'):
+            raise ValueError('overlap should be one of: skip, queue, allow')
+        self.func = func
+        self.every = every
+        self.cron = cron and _Cron(cron)
+        self.jitter = jitter
+        self.overlap = overlap
+        self.timeout = timeout
+        self.leader = leader
+        self.name = name or getattr(func, '__qualname__', repr(func))
+        self.metrics = Metrics(('runs', 'errors', 'timeouts', 'skipped'),
+                               ('running',), ('run', 'latency'))
+        self.running = 0
+        self.queued = False
+        self._at = None
+
+    def reset(self):
+        self._at = None
+        self.queued = False
+
+    def next_time(self, now):
+        if self.every:
+            # Fixed rate, missed runs are skipped
+            self._at = (self._at or now) + self.every
+            while self._at <= now:
+                self._at += self.every
+        else:
+            self._at = self.cron.next(now)
+        return self._at + (uniform(0, self.jitter) if self.jitter else 0)
+
+
 class GeventLifecycle:
-    def __init__(self, app, signal=[], exit=[], run=[], run_forever=[]):
+    def __init__(self, app, signal=[], exit=[], run=[], run_forever=[],
+                 schedule=[], leases=None, leader_ttl=30):
+        # schedule - list of (func, options), see schedule method
+        # leases - flask_gevent.leases.Leases, or True for FileLeases,
+        #   to elect single leader process for leader jobs
+        # leader_ttl - seconds to renew leader lease, if it's expiring
         self.app = app
         self.pool = gevent.pool.Pool()
+        # Started run jobs are kept to start them again after pause,
+        # e.g. in forked server worker
+        self.jobs = []
+        self.paused = False
+        # Scheduled jobs share one timer greenlet
+        self.scheduled = []
+        self.leases = FileLeases() if leases is True else _maybe_import(leases)
+        self.leader_key = 'lifecycle:leader:%s' % app.import_name
+        self.leader_ttl = leader_ttl
+        self.leader = False
+        self._leader_renewed = 0
+        self._queue = []  # heap of (time, seq, job)
+        self._seq = count()
+        self._wakeup = gevent.event.Event()
+        self._scheduler = None
 
         self._signal = [(_maybe_import(func), *args) for func, *args in signal]
         self._exit = [_maybe_import(func) for func in exit]
@@ -65,6 +189,8 @@ class GeventLifecycle:
             + [_run_forever(*args)(_maybe_import(func))
                for func, *args in run_forever]
         )
+        self._schedule = [_Job(_maybe_import(func), **options)
+                          for func, options in schedule]
         self._bind()
 
     def _bind(self):
@@ -72,18 +198,121 @@ class GeventLifecycle:
         # handlers after app initialization.
         for func, signalnums in self._signal:
             for signalnum in signalnums:
-                gevent.signal_handler(app_context(self.app)(func))
+                gevent.signal_handler(signalnum, app_context(self.app)(func))
         for func in self._run:
-            self.pool.spawn(app_context(self.app)(func))
+            self.jobs.append(func)
+            if not self.paused:
+                self._spawn_job(func)
+        for job in self._schedule:
+            self.scheduled.append(job)
+            if not self.paused:
+                self._add_job(job)
         for func in self._exit:
-            atexit_register(app_context(self.app))
+            atexit_register(app_context(self.app)(func))
         self._signal.clear()
         self._run.clear()
+        self._schedule.clear()
         self._exit.clear()
 
+    def pause(self, timeout=None):
+        self.paused = True
+        self.pool.kill(timeout=timeout)
+        self._queue.clear()
+        self._scheduler = None
+        if self.leader:
+            # Forked processes are electing leader again
+            self.leader = False
+            self.leases.release(self.leader_key)
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            for func in self.jobs:
+                self._spawn_job(func)
+            for job in self.scheduled:
+                job.reset()
+                self._add_job(job)
+
+    def _spawn_job(self, func):
+        greenlet = self.pool.spawn(app_context(self.app)(func))
+        set_origin('lifecycle:%s' % getattr(func, '__qualname__', func), greenlet)
+        return greenlet
+
+    def _add_job(self, job):
+        heappush(self._queue, (job.next_time(time()), next(self._seq), job))
+        if not self._scheduler:
+            self._scheduler = self._spawn_job(self._run_scheduler)
+        self._wakeup.set()
+
+    def _run_scheduler(self):
+        while True:
+            now = time()
+            while self._queue and self._queue[0][0] <= now:
+                at, _, job = heappop(self._queue)
+                self._start_job(job, at)
+                heappush(self._queue, (job.next_time(now), next(self._seq), job))
+            self._wakeup.clear()
+            self._wakeup.wait(self._queue[0][0] - now if self._queue else None)
+
+    def _is_leader(self):
+        if not self.leases:
+            return True
+        if self.leader and time() - self._leader_renewed > self.leader_ttl / 3:
+            self.leader = self.leases.renew(self.leader_key, self.leader_ttl)
+            self._leader_renewed = time()
+        if not self.leader:
+            self.leader = self.leases.acquire(self.leader_key, self.leader_ttl)
+            self._leader_renewed = time()
+        return self.leader
+
+    def _start_job(self, job, at):
+        if job.leader and not self._is_leader():
+            return
+        if job.running and job.overlap != 'allow':
+            if job.overlap == 'queue':
+                job.queued = True
+            else:
+                current_app.logger.debug('%s is still running, skipped', job.name)
+                job.metrics.inc('skipped')
+            return
+        job.running += 1
+        job.metrics.set('running', job.running)
+        greenlet = self.pool.spawn(app_context(self.app)(self._call_job), job, at)
+        set_origin('lifecycle:%s' % job.name, greenlet)
+
+    def _call_job(self, job, at):
+        try:
+            while True:
+                started = time()
+                job.metrics.observe('latency', max(0, started - at))
+                timeout = gevent.Timeout.start_new(job.timeout) if job.timeout else None
+                try:
+                    job.func()
+                except gevent.Timeout as exc:
+                    if exc is not timeout:
+                        raise
+                    job.metrics.inc('timeouts')
+                    current_app.logger.warning('%s timed out after %s seconds',
+                                               job.name, job.timeout)
+                except Exception as exc:
+                    job.metrics.inc('errors')
+                    current_app.logger.exception('%s failed: %r', job.name, exc)
+                finally:
+                    if timeout:
+                        timeout.cancel()
+                    job.metrics.inc('runs')
+                    job.metrics.observe('run', time() - started)
+                if not job.queued:
+                    break
+                # Overlapped run is started right after this one
+                job.queued, at = False, time()
+        finally:
+            job.running -= 1
+            job.metrics.set('running', job.running)
+
     def signal(self, signalnums):
         def decorator(func):
-            self._signal.append(func, frozenset(signalnums))
+            self._signal.append((func, frozenset(signalnums)))
             self._bind()
             return func
         return decorator
@@ -103,3 +332,23 @@ class GeventLifecycle:
             self.run(_run_forever(sleep, exit_on_error)(func))
             return func
         return decorator
+
+    def schedule(self, every=None, cron=None, jitter=0, overlap='skip',
+                 timeout=None, leader=False, name=None):
+        """
+        Runs function periodically, with all scheduled jobs sharing one timer.
+
+        :param every: seconds, fixed rate not drifting with run time
+        :param cron: cron expression, e.g. '*/5 * * * *', in local time
+        :param jitter: maximum random seconds added to each run time
+        :param overlap: if previous run is not finished - 'skip' this run,
+            'queue' to run it right after previous, or 'allow' concurrent runs
+        :param timeout: seconds, run is killed after it
+        :param leader: run only in leader process, see leases
+        """
+        def decorator(func):
+            self._schedule.append(_Job(func, every, cron, jitter, overlap,
+                                       timeout, leader, name))
+            self._bind()
+            return func
+        return decorator
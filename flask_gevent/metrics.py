@@ -0,0 +1,111 @@
+from bisect import bisect_left
+
+
+# Seconds, same as prometheus client defaults
+BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        rv, total = [], 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            rv.append((le, total))
+        return rv
+
+    def as_dict(self):
+        return {
+            'buckets': {_format_value(le): count for le, count in self.cumulative()},
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of pool or processor.
+    No locking is needed, as greenlets are switched only on blocking calls.
+    """
+    def __init__(self, counters=(), gauges=(), histograms=(), buckets=BUCKETS):
+        self.counters = dict.fromkeys(counters, 0)
+        self.gauges = dict.fromkeys(gauges, 0)
+        self.histograms = {name: Histogram(buckets) for name in histograms}
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def set_max(self, name, value):
+        if value > self.gauges[name]:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def as_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: histogram.as_dict()
+                           for name, histogram in self.histograms.items()},
+        }
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                 .replace('"', r'\"').replace('\n', r'\n'))
+                    for name, value in labels.items())
+
+
+def render_prometheus(prefix, label, metrics):
+    """
+    Renders mapping label value -> Metrics in prometheus text format,
+    e.g. render_prometheus('flask_gevent_pool', 'pool', {'default': metrics})
+    """
+    families = {}  # name -> (type, [lines])
+
+    def add(name, type_, labels, value, suffix=''):
+        lines = families.setdefault(name, (type_, []))[1]
+        lines.append('%s%s{%s} %s' % (name, suffix, _format_labels(labels),
+                                      _format_value(value)))
+
+    for label_value, m in metrics.items():
+        labels = {label: label_value}
+        for name, value in m.counters.items():
+            add('%s_%s_total' % (prefix, name), 'counter', labels, value)
+        for name, value in m.gauges.items():
+            add('%s_%s' % (prefix, name), 'gauge', labels, value)
+        for name, histogram in m.histograms.items():
+            name = '%s_%s_seconds' % (prefix, name)
+            for le, count in histogram.cumulative():
+                add(name, 'histogram', {**labels, 'le': _format_value(le)},
+                    count, '_bucket')
+            add(name, 'histogram', labels, histogram.sum, '_sum')
+            add(name, 'histogram', labels, histogram.count, '_count')
+
+    rv = []
+    for name, (type_, lines) in families.items():
+        rv.append('# TYPE %s %s' % (name, type_))
+        rv.extend(lines)
+    return '\n'.join(rv) + '\n'
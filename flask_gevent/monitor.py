@@ -0,0 +1,89 @@
+import sys
+import traceback
+from collections import deque
+from time import monotonic, time
+
+import gevent
+import gevent.events
+
+from .metrics import Metrics
+from .utils import get_origin
+
+
+class BlockingMonitor:
+    """
+    Measures hub loop lag and reports greenlets blocking the loop longer
+    than threshold, with stack and spawn origin (endpoint or lifecycle job).
+
+    Blocking is detected by gevent monitor thread, see gevent.config.monitor_thread.
+    """
+    def __init__(self, app, threshold=0.1, interval=0.1, reports=100,
+                 buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)):
+        # threshold - seconds greenlet may run without switching
+        # interval - seconds between loop lag measurements
+        # reports - number of last blocking reports to keep
+        self.app = app
+        self.threshold = threshold
+        self.interval = interval
+        self.reports = deque(maxlen=reports)
+        self.metrics = Metrics(('blocked',), ('last_lag', 'max_lag'), ('lag',),
+                               buckets)
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet:
+            return
+        gevent.config.monitor_thread = True
+        gevent.config.max_blocking_time = self.threshold
+        # Reports are logged with spawn origin instead
+        gevent.config.print_blocking_reports = False
+        gevent.events.subscribers.append(self._on_event)
+        gevent.get_hub().start_periodic_monitoring_thread()
+        self._greenlet = gevent.spawn(self._measure_lag)
+
+    def stop(self):
+        if self._greenlet:
+            gevent.events.subscribers.remove(self._on_event)
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _measure_lag(self):
+        while True:
+            started = monotonic()
+            gevent.sleep(self.interval)
+            lag = max(0, monotonic() - started - self.interval)
+            self.metrics.observe('lag', lag)
+            self.metrics.set('last_lag', lag)
+            self.metrics.set_max('max_lag', lag)
+
+    def _on_event(self, event):
+        # Called in monitor thread, while hub thread may still be blocked
+        if not isinstance(event, gevent.events.EventLoopBlocked):
+            return
+        try:
+            frame = sys._current_frames()[event.hub.thread_ident]
+        except (KeyError, AttributeError):
+            stack = []
+        else:
+            stack = traceback.format_stack(frame)
+        report = {
+            'time': time(),
+            'blocking_time': event.blocking_time,
+            'greenlet': repr(event.greenlet),
+            'origin': get_origin(event.greenlet),
+            'stack': ''.join(stack),
+        }
+        self.reports.append(report)
+        self.metrics.inc('blocked')
+        self.app.logger.warning(
+            'Event loop blocked for more than %s seconds by %s (origin %s):\n%s',
+            report['blocking_time'], report['greenlet'], report['origin'],
+            report['stack'])
+
+    def status(self):
+        return {
+            'last_lag': self.metrics.gauges['last_lag'],
+            'max_lag': self.metrics.gauges['max_lag'],
+            'blocked': self.metrics.counters['blocked'],
+            'last_report': self.reports[-1] if self.reports else None,
+        }
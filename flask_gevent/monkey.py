@@ -10,8 +10,17 @@ def patch_all(psycopg=True, **kwargs):
 
 
 def patch_sqlalchemy(db):
+    # Replaces engine QueuePool with GreenletQueuePool, other pools (e.g.
+    # StaticPool of in-memory sqlite) are kept as is,
+    # see flask_gevent.db.init_sqlalchemy for request pinning and size checks
+    from sqlalchemy.pool import QueuePool
+    from .db import GreenletQueuePool
     if hasattr(db, 'extensions'):
         if 'sqlalchemy' not in db.extensions:
             raise RuntimeError('sqlalchemy is not initialized on %s' % db)
         db = db.extensions['sqlalchemy'].db
-    db.engine.pool._use_threadlocal = True
+    if isinstance(db.engine.pool, QueuePool) and \
+            not isinstance(db.engine.pool, GreenletQueuePool):
+        pool = db.engine.pool
+        db.engine.pool = GreenletQueuePool.from_pool(pool)
+        pool.dispose()
@@ -0,0 +1,198 @@
+import os
+import pickle
+import signal
+import struct
+import traceback
+
+import gevent
+import gevent.os
+import gevent.queue
+import gevent.threadpool
+from gevent.event import AsyncResult
+from gevent.monkey import get_original
+
+from .utils import app_context
+
+# Patched close is deferred to next loop iteration for pipes, but fds
+# should be closed before next fork to not leak to other processes
+_close = get_original('os', 'close')
+
+
+class ThreadPool(gevent.threadpool.ThreadPool):
+    """
+    Native threads running function in app context, for blocking calls
+    of C-extensions and code releasing GIL. spawn returns AsyncResult.
+    """
+    def __init__(self, app, size=10):
+        super().__init__(size)
+        self.app = app
+
+    def spawn(self, func, *args, **kwargs):
+        return super().spawn(app_context(self.app)(func), *args, **kwargs)
+
+
+class _Process:
+    def __init__(self, pid, read_fd, write_fd):
+        self.pid = pid
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.alive = True
+
+    def close(self):
+        self.alive = False
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        _close(self.read_fd)
+        _close(self.write_fd)
+
+
+class ProcessPool:
+    """
+    Pre-forked processes running function in app context, for CPU-heavy work.
+    Function, arguments and result should be picklable.
+    spawn returns AsyncResult.
+
+    Processes are forked on first use in current process (or by start),
+    reused for next calls, and replaced if exited.
+    """
+    def __init__(self, app, size=None):
+        self.app = app
+        self.size = size or os.cpu_count() or 1
+        self._pid = None
+        self._idle = None
+        self._processes = set()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        # Processes forked in parent (e.g. server master) are not ours
+        self._pid = os.getpid()
+        self._idle = gevent.queue.Queue()
+        self._processes = set()
+        for _ in range(self.size):
+            self._idle.put(self._fork())
+
+    def kill(self):
+        for process in list(self._processes):
+            process.close()
+        self._processes.clear()
+        self._pid = None
+
+    def free_count(self):
+        return self._idle.qsize() if self._idle else self.size
+
+    def spawn(self, func, *args, **kwargs):
+        result = AsyncResult()
+        gevent.spawn(self._run, result, func, args, kwargs)
+        return result
+
+    def apply(self, func, *args, **kwargs):
+        return self.spawn(func, *args, **kwargs).get()
+
+    def _run(self, result, func, args, kwargs):
+        try:
+            self.start()
+            message = pickle.dumps((func, args, kwargs))
+        except BaseException as exc:
+            return result.set_exception(exc)
+
+        try:
+            process = self._idle.get()
+        except BaseException as exc:
+            return result.set_exception(exc)
+        if not process.alive:
+            self._processes.discard(process)
+            process.close()
+            process = self._fork()
+        try:
+            _send(process.write_fd, message, gevent.os.nb_write)
+            success, value = pickle.loads(_recv(process.read_fd, gevent.os.nb_read))
+        except BaseException as exc:
+            # Process exited, or is in the middle of message if we are killed
+            self._processes.discard(process)
+            process.close()
+            self._idle.put(self._fork())
+            result.set_exception(exc)
+        else:
+            self._idle.put(process)
+            if success:
+                result.set(value)
+            else:
+                result.set_exception(value)
+
+    def _fork(self):
+        parent_read, child_write = os.pipe()
+        child_read, parent_write = os.pipe()
+        pid = gevent.os.fork_and_watch(self._on_exit, ref=False)
+        if not pid:
+            for fd in [parent_read, parent_write] + [
+                    fd for process in self._processes
+                    for fd in (process.read_fd, process.write_fd)]:
+                _close(fd)
+            code = 0
+            try:
+                _serve_process(self.app, child_read, child_write)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        _close(child_read)
+        _close(child_write)
+        gevent.os.make_nonblocking(parent_read)
+        gevent.os.make_nonblocking(parent_write)
+        process = _Process(pid, parent_read, parent_write)
+        self._processes.add(process)
+        return process
+
+    def _on_exit(self, watcher):
+        for process in self._processes:
+            if process.pid == watcher.pid:
+                process.alive = False
+
+
+def _serve_process(app, read_fd, write_fd):
+    # Master forwards SIGTERM, terminal sends SIGINT to whole process group
+    for signalnum in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signalnum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            message = _recv(read_fd, os.read)
+        except EOFError:
+            # Parent exited
+            return
+        try:
+            func, args, kwargs = pickle.loads(message)
+            with app.app_context():
+                rv = (True, func(*args, **kwargs))
+        except Exception as exc:
+            rv = (False, exc)
+        try:
+            message = pickle.dumps(rv)
+        except Exception:
+            message = pickle.dumps((False, RuntimeError(traceback.format_exc())))
+        _send(write_fd, message, os.write)
+
+
+def _send(fd, message, write):
+    message = memoryview(struct.pack('!Q', len(message)) + message)
+    while message:
+        message = message[write(fd, message):]
+
+
+def _recv(fd, read):
+    size, = struct.unpack('!Q', _read_exactly(fd, 8, read))
+    return _read_exactly(fd, size, read)
+
+
+def _read_exactly(fd, size, read):
+    chunks = []
+    while size:
+        chunk = read(fd, min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Process pool process exited')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
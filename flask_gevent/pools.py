@@ -0,0 +1,313 @@
+from collections import deque
+from contextlib import contextmanager
+from heapq import heapify, heappop, heappush
+from itertools import count
+from math import sqrt
+from time import monotonic
+
+from gevent import getcurrent
+from gevent.event import AsyncResult
+
+from . import Pool
+from .utils import get_origin
+
+
+class _FairSemaphore:
+    # Replaces Pool semaphore: free slot is given to waiter of highest
+    # priority class, within class by weighted fair queuing across keys
+    # (start-time fair queuing, key weight is its share of slots).
+    # Priority and key are taken from spawning greenlet, see PriorityPool.priority
+    def __init__(self, size, priorities, default_priority, weights,
+                 max_waiting, reject):
+        self.counter = size
+        self.priorities = {priority: index for index, priority in enumerate(priorities)}
+        self.default_priority = default_priority
+        self.weights = weights
+        self.max_waiting = max_waiting
+        self.reject = reject
+        self.queues = [[] for _ in priorities]  # heaps of (tag, seq, waiter)
+        self.waiting = 0
+        self.rejected = 0
+        self._vtime = 0
+        self._finish = {}  # (priority index, key) -> last virtual finish tag
+        self._seq = count()
+
+    def acquire(self, blocking=True, timeout=None):
+        if self.counter > 0 and not self.waiting:
+            self.counter -= 1
+            return True
+        if not blocking:
+            return False
+
+        current = getcurrent()
+        index = self.priorities[getattr(current, 'spawn_priority', None)
+                                or self.default_priority]
+        key = getattr(current, 'spawn_key', None) or get_origin(current)
+        if self.max_waiting is not None and self.waiting >= self.max_waiting:
+            if not (self.reject == 'lowest' and self._reject_lowest(index)):
+                self.rejected += 1
+                return False
+
+        tag = max(self._vtime, self._finish.get((index, key), 0)) \
+            + 1 / self.weights.get(key, 1)
+        self._finish[(index, key)] = tag
+        if len(self._finish) > 10000:
+            self._finish = {k: t for k, t in self._finish.items() if t > self._vtime}
+        waiter = AsyncResult()
+        heappush(self.queues[index], (tag, next(self._seq), waiter))
+        self.waiting += 1
+
+        try:
+            waiter.wait(timeout)
+        except BaseException:
+            if waiter.ready():
+                if waiter.value:
+                    # Slot was given already, passing it to next waiter
+                    self.release()
+            else:
+                self._cancel(waiter)
+            raise
+        if not waiter.ready():
+            self._cancel(waiter)
+            return False
+        return waiter.value
+
+    def _cancel(self, waiter):
+        # Cancelled waiter is skipped by release
+        waiter.set(None)
+        self.waiting -= 1
+
+    def _reject_lowest(self, index):
+        # Rejects last waiter of lower priority than index, if any
+        for queue in reversed(self.queues[index + 1:]):
+            live = [item for item in queue if not item[2].ready()]
+            if live:
+                item = max(live)
+                queue.remove(item)
+                heapify(queue)
+                self.waiting -= 1
+                self.rejected += 1
+                item[2].set(False)
+                return True
+        return False
+
+    def release(self):
+        for queue in self.queues:
+            while queue:
+                tag, _, waiter = heappop(queue)
+                if waiter.ready():
+                    continue
+                self._vtime = tag
+                self.waiting -= 1
+                waiter.set(True)
+                return
+        self.counter += 1
+
+    def wait(self, timeout=None):
+        if self.counter > 0 and not self.waiting:
+            return self.counter
+        # Waiting for turn, then giving slot to next waiter
+        if not self.acquire(timeout=timeout):
+            return 0
+        self.release()
+        return max(self.counter, 1)
+
+
+class PriorityPool(Pool):
+    """
+    Pool giving free slots by priority class, and within class by weighted
+    fair queuing across keys (tenant, caller, spawn origin by default),
+    instead of whoever wakes up first.
+
+    :param priorities: priority classes, highest first
+    :param weights: mapping key -> weight, 1 by default
+    :param max_waiting: maximum greenlets waiting for slot, then PoolFull is raised
+    :param reject: on max_waiting - 'new' rejects spawning greenlet,
+        'lowest' rejects last waiting greenlet of lower priority if any
+    """
+    def __init__(self, size, greenlet_class=None,
+                 priorities=('interactive', 'default', 'background'),
+                 default_priority='default', weights={}, max_waiting=None,
+                 reject='new'):
+        if size is None:
+            raise ValueError('size is required')
+        if reject not in ('new', 'lowest'):
+            raise ValueError('reject should be one of: new, lowest')
+        super().__init__(size, greenlet_class)
+        self._semaphore = _FairSemaphore(size, priorities, default_priority,
+                                         weights, max_waiting, reject)
+        self.metrics.counters['rejected'] = 0
+        self.metrics.gauges['waiting'] = 0
+
+    def add(self, greenlet, *args, **kwargs):
+        try:
+            return super().add(greenlet, *args, **kwargs)
+        finally:
+            self.metrics.set('waiting', self.waiting)
+            self.metrics.counters['rejected'] = self.rejected
+
+    @property
+    def waiting(self):
+        return self._semaphore.waiting
+
+    @property
+    def rejected(self):
+        return self._semaphore.rejected
+
+    @contextmanager
+    def priority(self, priority=None, key=None):
+        # Priority and fair queuing key for spawns in this block
+        current = getcurrent()
+        prev = (getattr(current, 'spawn_priority', None),
+                getattr(current, 'spawn_key', None))
+        current.spawn_priority, current.spawn_key = priority, key
+        try:
+            yield
+        finally:
+            current.spawn_priority, current.spawn_key = prev
+
+    def spawn_with(self, priority, key, func, *args, **kwargs):
+        with self.priority(priority, key):
+            return self.spawn(func, *args, **kwargs)
+
+
+class _LimitSemaphore:
+    # Replaces Pool semaphore, limit may be changed at runtime
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiters = deque()
+
+    @property
+    def counter(self):
+        return max(0, self.limit - self.used)
+
+    def acquire(self, blocking=True, timeout=None):
+        if self.used < self.limit and not self.waiters:
+            self.used += 1
+            return True
+        if not blocking:
+            return False
+        waiter = AsyncResult()
+        self.waiters.append(waiter)
+        try:
+            waiter.wait(timeout)
+        except BaseException:
+            if waiter.ready():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+        if not waiter.ready():
+            self.waiters.remove(waiter)
+            return False
+        return True
+
+    def release(self):
+        self.used -= 1
+        self._wake()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.used < self.limit:
+            self.used += 1
+            self.waiters.popleft().set(True)
+
+    def wait(self, timeout=None):
+        if self.counter:
+            return self.counter
+        if not self.acquire(timeout=timeout):
+            return 0
+        self.release()
+        return max(self.counter, 1)
+
+
+class AdaptivePool(Pool):
+    """
+    Pool adjusting its size (concurrency limit) between min_size and max_size
+    by observed greenlet run time and errors, to not overload slow upstream
+    and not waste capacity of healthy one.
+
+    Greenlet raising or returning exception (as EntityBulkProcessor worker does)
+    is counted as error.
+
+    :param algorithm: 'aimd' - additive increase while greenlets are fast,
+        multiplicative decrease on error or run time above latency_threshold;
+        'gradient' - limit follows ratio of long-term to recent run time,
+        decreased on errors as well
+    :param latency_threshold: seconds, for 'aimd' only, not checked if None
+    :param backoff: multiplier of limit on decrease
+    :param smoothing: 'gradient' limit change factor, from 0 to 1
+    :param tolerance: 'gradient' allowed ratio of recent to long-term run time
+    """
+    def __init__(self, size=10, greenlet_class=None, min_size=1, max_size=1000,
+                 algorithm='gradient', latency_threshold=None, backoff=0.9,
+                 smoothing=0.2, tolerance=1.5):
+        if algorithm not in ('aimd', 'gradient'):
+            raise ValueError('algorithm should be one of: aimd, gradient')
+        super().__init__(size, greenlet_class)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.algorithm = algorithm
+        self.latency_threshold = latency_threshold
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self._semaphore = _LimitSemaphore(size)
+        self._limit = float(size)
+        self._rtt_long = None
+        self._window = []
+        self._decreased = 0
+        self.metrics.gauges['limit'] = size
+
+    def _discard(self, greenlet):
+        added = self._added.get(greenlet)
+        super()._discard(greenlet)
+        if added is not None and greenlet.ready():
+            self._sample(monotonic() - added,
+                         not greenlet.successful()
+                         or isinstance(greenlet.value, Exception))
+
+    def _sample(self, rtt, failed):
+        limit = self._limit
+        if failed:
+            # Decreasing at most once per run time, as failures come in bursts
+            if monotonic() - self._decreased > rtt:
+                self._decreased = monotonic()
+                limit *= self.backoff
+        elif self.algorithm == 'aimd':
+            if self.latency_threshold and rtt > self.latency_threshold:
+                if monotonic() - self._decreased > rtt:
+                    self._decreased = monotonic()
+                    limit *= self.backoff
+            elif len(self) * 2 >= limit:
+                # Increasing only if limit is actually used
+                limit += 1 / limit
+        else:
+            # Limit is updated once per window of samples, by average run time
+            self._window.append(rtt)
+            if len(self._window) < max(10, limit):
+                return
+            rtt = sum(self._window) / len(self._window)
+            self._window.clear()
+            if self._rtt_long is None:
+                self._rtt_long = rtt
+            self._rtt_long += (rtt - self._rtt_long) * 0.05
+            if self._rtt_long > rtt * 2:
+                # Load is decreased, long-term run time should recover faster
+                self._rtt_long = rtt * 2
+            gradient = max(0.5, min(1.0, self.tolerance * self._rtt_long / rtt))
+            new_limit = limit * gradient + sqrt(limit)
+            limit += (new_limit - limit) * self.smoothing
+        self._set_limit(limit)
+
+    def _set_limit(self, limit):
+        self._limit = min(self.max_size, max(self.min_size, limit))
+        size = int(self._limit)
+        if size != self.size:
+            self.size = size
+            self._semaphore.set_limit(size)
+            self.metrics.set('limit', size)
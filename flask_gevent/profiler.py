@@ -0,0 +1,180 @@
+import json
+import os
+import sys
+import tempfile
+from time import time
+
+import gevent
+import greenlet
+from gevent.monkey import get_original
+
+from .helpers import EntityBulkProcessor
+from .utils import get_origin
+
+# Sampling thread is native thread even if threading is monkey patched
+_start_new_thread, _allocate_lock = get_original(
+    '_thread', ['start_new_thread', 'allocate_lock'])
+_sleep = get_original('time', 'sleep')
+
+
+class SamplingProfiler:
+    """
+    Samples stack of running greenlet from native thread, split by spawn
+    origin (endpoint or lifecycle job), named pool and bulk processor of
+    greenlet. Samples of idle hub are not recorded.
+
+    Current greenlet is tracked by greenlet.settrace only while profiling.
+    """
+    def __init__(self, app, interval=0.005, max_stacks=10000, output=None):
+        # interval - seconds between samples
+        # max_stacks - maximum distinct stacks, others are counted as truncated
+        # output - path to write profile stopped by toggle, in temp dir by default
+        self.app = app
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.output = output
+        self.samples = {}  # (label, frames) -> count
+        self.sampled = 0
+        self.idle = 0
+        self.truncated = 0
+        self.started = None
+        self.stopped = None
+        self.running = False
+        self._current = None
+        self._hub = None
+        self._prev_trace = None
+        self._lock = _allocate_lock()
+
+    def start(self, interval=None):
+        if self.running:
+            raise RuntimeError('Profiler is running already')
+        self.interval = interval or self.interval
+        self.samples = {}
+        self.sampled = self.idle = self.truncated = 0
+        self.started, self.stopped = time(), None
+        self._hub = gevent.get_hub()
+        self._current = gevent.getcurrent()
+        # Tracer is per thread, so it's hub thread one
+        self._prev_trace = greenlet.settrace(self._trace)
+        self.running = True
+        self._lock.acquire()
+        _start_new_thread(self._run, (self._hub.thread_ident,))
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        # Waiting for sampling thread to finish, at most one interval
+        self._lock.acquire()
+        self._lock.release()
+        greenlet.settrace(self._prev_trace)
+        self._prev_trace = self._current = None
+        self.stopped = time()
+
+    def toggle(self):
+        # Signal handler, writes profile on stop
+        if not self.running:
+            self.start()
+            self.app.logger.info('Profiler started')
+            return
+        self.stop()
+        path = self.output or os.path.join(
+            tempfile.gettempdir(), 'flask_gevent-%d-%d.speedscope.json'
+            % (os.getpid(), self.started))
+        with open(path, 'w') as f:
+            json.dump(self.speedscope(), f)
+        self.app.logger.info('Profiler stopped, profile is written to %s', path)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self._current = args[1]
+        if self._prev_trace:
+            self._prev_trace(event, args)
+
+    def _run(self, thread_ident):
+        try:
+            while self.running:
+                _sleep(self.interval)
+                current = self._current
+                if current is None or current is self._hub:
+                    self.idle += 1
+                    continue
+                frame = sys._current_frames().get(thread_ident)
+                if frame is None:
+                    continue
+                self._record(self._get_label(current), frame)
+        finally:
+            self._lock.release()
+
+    def _record(self, label, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append((getattr(code, 'co_qualname', code.co_name),
+                           code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        self.sampled += 1
+        key = (label, tuple(reversed(frames)))
+        if key in self.samples:
+            self.samples[key] += 1
+        elif len(self.samples) < self.max_stacks:
+            self.samples[key] = 1
+        else:
+            self.truncated += 1
+
+    def _get_label(self, current):
+        label = [get_origin(current) or 'unknown']
+        for name, pool in self.app.extensions['gevent'].pools.items():
+            if current in pool.greenlets:
+                label.append('pool:%s' % name)
+                break
+        target = getattr(current, '_target', None) or getattr(current, '_run', None)
+        processor = getattr(target, '__self__', None)
+        if isinstance(processor, EntityBulkProcessor):
+            label.append('processor:%s' % processor.name)
+        return ';'.join(label)
+
+    def collapsed(self):
+        # Brendan Gregg's collapsed stacks for flamegraph.pl, speedscope, etc
+        lines = []
+        for (label, frames), count in sorted(self.samples.items()):
+            lines.append('%s;%s %d' % (label, ';'.join(
+                '%s (%s:%d)' % frame for frame in frames), count))
+        return '\n'.join(lines) + '\n'
+
+    def speedscope(self):
+        # https://www.speedscope.app/file-format-schema.json, profile per label
+        frames, indexes, profiles = [], {}, {}
+        for (label, stack), count in self.samples.items():
+            sample = []
+            for frame in stack:
+                if frame not in indexes:
+                    indexes[frame] = len(frames)
+                    name, file, line = frame
+                    frames.append({'name': name, 'file': file, 'line': line})
+                sample.append(indexes[frame])
+            profile = profiles.setdefault(label, {
+                'type': 'sampled', 'name': label, 'unit': 'seconds',
+                'startValue': 0, 'endValue': 0, 'samples': [], 'weights': [],
+            })
+            profile['samples'].append(sample)
+            profile['weights'].append(count * self.interval)
+            profile['endValue'] += count * self.interval
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames},
+            'profiles': sorted(profiles.values(), key=lambda p: -p['endValue']),
+            'name': '%s %d' % (self.app.import_name, os.getpid()),
+            'exporter': 'flask_gevent',
+        }
+
+    def status(self):
+        return {
+            'running': self.running,
+            'started': self.started,
+            'stopped': self.stopped,
+            'interval': self.interval,
+            'samples': self.sampled,
+            'idle': self.idle,
+            'truncated': self.truncated,
+        }
@@ -1,9 +1,25 @@
+import os
 import sys
+import time
 import signal
+import socket
 
 import gevent
+import gevent.greenlet
+import gevent.lock
+import gevent.os
 import gevent.pool
+import gevent.queue
 import gevent.pywsgi
+import gevent.socket
+import gevent.ssl
+import gevent.subprocess
+
+from werkzeug.wsgi import ClosingIterator, FileWrapper
+
+from . import Pool
+from .metrics import Metrics
+from .utils import get_request_scope
 
 
 def serve_forever(app, **kwargs):
@@ -14,20 +30,431 @@ def serve_forever(app, **kwargs):
     host, port = get_config('listen', '127.0.0.1:8088').split(':')
     exit_signals = get_config('exit_signals', [signal.SIGTERM, signal.SIGINT])
     pool_size = get_config('pool_size', None)
-    spawn = get_config('spawn', gevent.pool.Pool(pool_size))
+    # Handlers push own request context, so plain greenlets are used
+    spawn = get_config('spawn', Pool(pool_size,
+                                     greenlet_class=gevent.greenlet.Greenlet))
+    # 0 - serve in current process without master
+    workers = get_config('workers', os.cpu_count() or 1)
+    # 'one' - lifecycle run jobs are started in first worker only, 'all' - in each
+    lifecycle_workers = get_config('lifecycle_workers', 'one')
+    # SIGHUP/SIGUSR2 starts new process with same command line, inheriting
+    # listening socket, which stops this one when ready
+    reload_signals = get_config('reload_signals', [signal.SIGHUP, signal.SIGUSR2])
+    # Connections queued on listener of each worker are reset when it's closed,
+    # so it's shared listener by default if reload is enabled
+    reuse_port = get_config('reuse_port', hasattr(socket, 'SO_REUSEPORT')
+                            and not reload_signals)
+    if reuse_port and reload_signals and workers:
+        app.logger.warning('Reload with reuse_port resets connections queued '
+                           'on listeners of old workers')
+    backlog = get_config('backlog', 1024)
+    stop_timeout = get_config('stop_timeout', 10)
+    # Admission control, disabled if max_in_flight is None
+    max_in_flight = get_config('max_in_flight', None)
+    max_waiting = get_config('max_waiting', max_in_flight)
+    queue_timeout = get_config('queue_timeout', 1.0)
+    retry_after = get_config('retry_after', 1)
+    request_start_header = get_config('request_start_header', 'X-Request-Start')
+    # Seconds to wait for next request on connection, None - forever,
+    # 0 - connection is closed after each response
+    kwargs['keepalive'] = get_config('keepalive', None)
+    # Bytes of request read buffer, io.DEFAULT_BUFFER_SIZE if None
+    kwargs['read_buffer'] = get_config('read_buffer', None)
+    # Responses with Content-Length up to it are sent with headers at once
+    kwargs['write_buffer'] = get_config('write_buffer', 64 * 1024)
+    # wsgi.file_wrapper responses of regular files are sent by os.sendfile
+    kwargs['sendfile'] = get_config('sendfile', True)
+
+    if max_in_flight is not None:
+        # Inside of request collapsing if enabled, so requests waiting for
+        # identical in-flight request don't hold slots and are not shed
+        options = (max_in_flight, max_waiting, queue_timeout, retry_after,
+                   request_start_header)
+        collapse = app.extensions['gevent'].collapse
+        if collapse is not None:
+            admission = collapse.app = AdmissionControl(collapse.app, *options)
+        else:
+            admission = app.wsgi_app = AdmissionControl(app.wsgi_app, *options)
+        app.extensions['gevent'].admission = admission
+
+    # Called with app in each new (worker) process before it starts accepting
+    warmup = get_config('warmup', None)
 
     # Well, it don't looks like good idea...
     # log = get_config('log', app.logger)
     # error_log = get_config('error_log', app.logger)
 
+    # Set for process started by reload, see _reload
+    fd = os.environ.pop('FLASK_GEVENT_FD', None)
+    reload_pid = os.environ.pop('FLASK_GEVENT_RELOAD_PID', None)
+    reload_pid = reload_pid and int(reload_pid)
+
+    if not workers:
+        if fd:
+            listener = gevent.socket.socket(fileno=int(fd))
+        else:
+            listener = _bind_socket((host, int(port)), backlog)
+        reload_handlers = [gevent.signal_handler(sig, _reload, listener)
+                           for sig in reload_signals]
+        try:
+            return _serve(app, listener, spawn, exit_signals, stop_timeout,
+                          warmup, lambda: _stop_reloaded(reload_pid), **kwargs)
+        finally:
+            for handler in reload_handlers:
+                handler.cancel()
+
+    if lifecycle_workers not in ('one', 'all'):
+        raise ValueError('lifecycle_workers should be one of: one, all')
+
+    # With SO_REUSEPORT master socket is not listening and only holds the
+    # address, each worker binds own listener and kernel balances connections.
+    if fd:
+        listener = gevent.socket.socket(fileno=int(fd))
+    else:
+        listener = _bind_socket((host, int(port)), backlog, reuse_port,
+                                listen=not reuse_port)
+    address = listener.getsockname()
+
+    lifecycle = app.extensions['gevent'].lifecycle
+    lifecycle.pause()
+
+    index, ready = _supervise(workers, stop_timeout, exit_signals,
+                              reload_signals, listener, reload_pid)
+
+    if reuse_port:
+        worker_listener = _bind_socket(address, backlog, reuse_port)
+        listener.close()
+        listener = worker_listener
+    if lifecycle_workers == 'all' or index == 0:
+        lifecycle.resume()
+    # Master is notified when worker is ready
+    _serve(app, listener, spawn, [signal.SIGTERM], stop_timeout, warmup, ready,
+           **kwargs)
+    sys.exit(0)
+
+
+def _bind_socket(address, backlog, reuse_port=False, listen=True):
+    sock = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    if listen:
+        sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
+def _reload(listener):
+    # Starts new process with same command line and listening socket
+    if getattr(_reload, 'process', None) and _reload.process.poll() is None:
+        sys.stderr.write('Reload is in progress already\n')
+        return
+    listener.set_inheritable(True)
+    env = dict(os.environ, FLASK_GEVENT_FD=str(listener.fileno()),
+               FLASK_GEVENT_RELOAD_PID=str(os.getpid()))
+    args = getattr(sys, 'orig_argv', [sys.executable] + sys.argv)
+    sys.stderr.write('Reloading: starting new process\n')
+    _reload.process = gevent.subprocess.Popen(
+        args, executable=sys.executable, env=env, pass_fds=[listener.fileno()])
+
+
+def _stop_reloaded(pid):
+    # Gracefully stops process which started reload of this one
+    if pid:
+        sys.stderr.write('Reloaded, stopping old process %d\n' % pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def _supervise(workers, stop_timeout, exit_signals, reload_signals, listener,
+               reload_pid=None):
+    # Forks workers and restarts them on exit, returns only in worker process
+    # with worker index and ready callback, exits master process when all
+    # workers are stopped.
+    children = {}  # pid -> (index, started)
+    finished = gevent.queue.Queue()
+    log = sys.stderr
+    # Workers write index to pipe when ready, as signals of several workers
+    # may be coalesced, reloaded process is stopped when all are ready
+    ready_pipe = reload_pid and os.pipe()
+
+    def fork(index):
+        pid = gevent.os.fork_and_watch(finished.put, ref=True)
+        if pid:
+            children[pid] = (index, time.monotonic())
+        return pid
+
+    def stop():
+        if hasattr(stop, 'stopping'):
+            log.write('Multiple exit signals received - killing workers\n')
+            return kill(signal.SIGKILL)
+        stop.stopping = True
+        log.write('Master stopping %d workers\n' % len(children))
+        kill(signal.SIGTERM)
+        # Workers drain requests for stop_timeout, then stop pools
+        gevent.spawn_later(stop_timeout + 5, kill, signal.SIGKILL)
+
+    def kill(signalnum):
+        for pid in list(children):
+            try:
+                os.kill(pid, signalnum)
+            except ProcessLookupError:
+                pass
+
+    def wait_ready():
+        ready, buffer = set(), b''
+        while len(ready) < workers:
+            buffer += gevent.os.nb_read(ready_pipe[0], 1024)
+            *indexes, buffer = buffer.split(b'\n')
+            ready.update(indexes)
+        wait_ready.done = True
+        for fd in ready_pipe:
+            os.close(fd)
+        _stop_reloaded(reload_pid)
+
+    handlers = [gevent.signal_handler(sig, stop) for sig in exit_signals]
+    handlers += [gevent.signal_handler(sig, _reload, listener)
+                 for sig in reload_signals]
+
+    def child(index):
+        for handler in handlers:
+            handler.cancel()
+        # Terminal sends SIGINT to whole process group, master forwards SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for sig in reload_signals:
+            signal.signal(sig, signal.SIG_IGN)
+        if not ready_pipe or hasattr(wait_ready, 'done'):
+            return index, None
+        os.close(ready_pipe[0])
+
+        def ready():
+            try:
+                os.write(ready_pipe[1], b'%d\n' % index)
+            except OSError:
+                pass  # Master is not waiting for it anymore
+        return index, ready
+
+    for index in range(workers):
+        if not fork(index):
+            return child(index)
+    log.write('Master %d started %d workers\n' % (os.getpid(), workers))
+    if ready_pipe:
+        gevent.os.make_nonblocking(ready_pipe[0])
+        gevent.spawn(wait_ready)
+
+    while children:
+        watcher = finished.get()
+        index, started = children.pop(watcher.pid)
+        if hasattr(stop, 'stopping'):
+            continue
+        log.write('Worker %d exited with status %d, restarting\n'
+                  % (watcher.pid, watcher.rstatus))
+        if time.monotonic() - started < 1:
+            # Do not fork in a tight loop if worker fails on start
+            gevent.sleep(1)
+        if not fork(index):
+            return child(index)
+    log.write('Master stopped\n')
+    sys.exit(0)
+
+
+class _FileWrapper(FileWrapper):
+    # wsgi.file_wrapper, sent by _Handler with os.sendfile if possible
+    def __init__(self, file, buffer_size=8192):
+        super().__init__(file, buffer_size)
+        self.callbacks = []
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for callback in self.callbacks:
+                callback()
+
+
+class _Handler(gevent.pywsgi.WSGIHandler):
+    # While server is draining idle keep-alive connections are closed,
+    # and busy ones after response
+    def __init__(self, sock, address, server, *args, **kwargs):
+        super().__init__(sock, address, server, *args, **kwargs)
+        if server.read_buffer:
+            self.rfile.close()
+            self.rfile = sock.makefile('rb', server.read_buffer)
+
+    def read_requestline(self):
+        if self.server.draining:
+            return ''
+        received = False
+        self.server.idle.add(gevent.getcurrent())
+        try:
+            # Idle connection is closed after keepalive seconds
+            with gevent.Timeout(self.server.keepalive or None, False):
+                if not hasattr(self.rfile, 'peek'):
+                    return super().read_requestline()
+                # Connection is idle (closed by drain) only until first byte
+                # of next request, so request being read is not lost
+                received = bool(self.rfile.peek(1))
+        finally:
+            self.server.idle.discard(gevent.getcurrent())
+        return super().read_requestline() if received else ''
+
+    def read_request(self, raw_requestline):
+        rv = super().read_request(raw_requestline)
+        if self.server.keepalive == 0:
+            self.close_connection = True
+        return rv
+
+    def get_environ(self):
+        environ = super().get_environ()
+        if self.server.sendfile:
+            environ['wsgi.file_wrapper'] = _FileWrapper
+        return environ
+
+    def run_application(self):
+        # Client disconnect is detected while app is running, only for
+        # requests without body, which app doesn't read from socket, not TLS
+        if self.content_length or isinstance(self.socket, gevent.ssl.SSLSocket) \
+                or self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            return super().run_application()
+        watcher = gevent.spawn(self._watch_disconnect, gevent.getcurrent())
+        try:
+            return super().run_application()
+        finally:
+            watcher.kill()
+
+    def _watch_disconnect(self, greenlet):
+        # Socket is readable on EOF, or if client sends next request already,
+        # then disconnect is not detected
+        while True:
+            try:
+                if self.socket.recv(1, socket.MSG_PEEK):
+                    return
+                break
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+        # Request is abandoned, see Gevent._finish_request_scope
+        scope = get_request_scope(greenlet)
+        if scope:
+            scope.limit(0)
+
+    def start_response(self, status, headers, exc_info=None):
+        if (self.server.draining or self.close_connection) and \
+                not any(name.lower() == 'connection' for name, _ in headers):
+            headers = list(headers) + [('Connection', 'close')]
+        return super().start_response(status, headers, exc_info)
+
+    def process_result(self):
+        # Content-Length is of this response only if start_response is called
+        content_length = self.status and self.provided_content_length
+        if content_length is None or not content_length.isdigit():
+            return super().process_result()
+        if isinstance(self.result, _FileWrapper) and \
+                self._sendfile(int(content_length)):
+            return
+        if self.headers_sent or int(content_length) > self.server.write_buffer:
+            return super().process_result()
+        # Small body is buffered to be sent with headers in one write
+        data = bytearray()
+        result = iter(self.result)
+        for chunk in result:
+            data += chunk
+            if len(data) > self.server.write_buffer:
+                break
+        self.write(bytes(data))
+        for chunk in result:
+            if chunk:
+                self.write(chunk)
+
+    def _write_with_headers(self, data):
+        if len(data) > self.server.write_buffer:
+            return super()._write_with_headers(data)
+        self.headers_sent = True
+        self.finalize_headers()
+        towrite = bytearray(b'HTTP/1.1 ')
+        towrite += self.status
+        towrite += b'\r\n'
+        for header, value in self.response_headers:
+            towrite += header
+            towrite += b': '
+            towrite += value
+            towrite += b'\r\n'
+        towrite += b'\r\n'
+        if data and self.response_use_chunked:
+            towrite += b'%x\r\n' % len(data)
+            towrite += data
+            towrite += b'\r\n'
+        else:
+            towrite += data
+        self._sendall(towrite)
+
+    def _sendfile(self, remaining):
+        # Returns False if file can't be sent by sendfile, e.g. not regular
+        # file or it's TLS connection, then it's iterated as usual
+        if self.headers_sent or self.code in (204, 304) or \
+                self.environ['REQUEST_METHOD'] == 'HEAD' or \
+                isinstance(self.socket, gevent.ssl.SSLSocket):
+            return False
+        try:
+            fd = self.result.file.fileno()
+            offset = self.result.file.tell()
+        except (AttributeError, OSError, ValueError):
+            return False
+        self._write_with_headers(b'')
+        sock = self.socket.fileno()
+        while remaining:
+            try:
+                sent = os.sendfile(sock, fd, offset, remaining)
+            except BlockingIOError:
+                gevent.socket.wait_write(sock, timeout=self.socket.timeout)
+                continue
+            if not sent:
+                # File is shorter than Content-Length, response is broken
+                self.close_connection = True
+                break
+            offset += sent
+            remaining -= sent
+            self.response_length += sent
+        return True
+
+
+class _Server(gevent.pywsgi.WSGIServer):
+    handler_class = _Handler
+
+    def __init__(self, *args, keepalive=None, read_buffer=None, write_buffer=64 * 1024,
+                 sendfile=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keepalive = keepalive
+        self.read_buffer = read_buffer
+        self.write_buffer = write_buffer
+        self.sendfile = sendfile
+        self.draining = False
+        self.idle = set()  # greenlets waiting for next request on connection
+
+    def drain(self):
+        # Stops accepting, waits up to stop_timeout for requests in progress
+        self.draining = True
+        self.close()
+        for greenlet in list(self.idle):
+            greenlet.kill(block=False)
+        self.stop()
+
+
+def _serve(app, listener, spawn, exit_signals, stop_timeout=10, warmup=None,
+           ready=None, **kwargs):
     pools = app.extensions['gevent'].pools
     lifecycle = app.extensions['gevent'].lifecycle
 
     if isinstance(spawn, gevent.pool.Pool):
         pools['_server'] = spawn
 
-    server = gevent.pywsgi.WSGIServer(
-        (host, int(port)), app, spawn=spawn, **kwargs)
+    server = _Server(listener, app, spawn=spawn, **kwargs)
+    # Also used by serve_forever on stop
+    server.stop_timeout = stop_timeout
 
     def exit():
         if hasattr(exit, 'exiting'):
@@ -36,14 +463,124 @@ def serve_forever(app, **kwargs):
             finally:
                 return sys.exit('Multiple exit signals received - aborting')
         exit.exiting = True
-        server.log.write('Server stopping\n')
+        server.log.write('Server stopping, draining requests\n')
+        server.drain()
+        # Only when requests are finished, as they may use pools and jobs
         lifecycle.pool.kill(timeout=5)
-        server.stop(timeout=5)
         for name, pool in pools.items():
             pool.kill(timeout=5)
+        for pool in app.extensions['gevent'].process_pools.values():
+            pool.kill()
+        # Threads exit when their tasks are done
+        for pool in app.extensions['gevent'].thread_pools.values():
+            pool.kill()
         server.log.write('Server stopped gracefully\n')
 
-    [gevent.signal(sig, exit) for sig in exit_signals]
+    [gevent.signal_handler(sig, exit) for sig in exit_signals]
 
-    server.log.write('Server starting on %s:%s\n' % (host, port))
+    if warmup:
+        warmup(app)
+    server.start()
+    server.log.write('Server starting on %s:%s (pid %d)\n'
+                     % (*listener.getsockname()[:2], os.getpid()))
+    if ready:
+        ready()
     server.serve_forever()
+
+
+class AdmissionControl:
+    """
+    WSGI middleware limiting requests running in app to max_in_flight.
+    Request waits for free slot up to queue_timeout since it was started
+    (by request_start_header set by proxy, e.g. nginx "t=${msec}", or since
+    it was read), otherwise or if max_waiting requests are waiting already
+    fast 503 response with Retry-After is sent without running the app.
+    """
+    def __init__(self, app, max_in_flight, max_waiting=None, queue_timeout=1.0,
+                 retry_after=1, request_start_header='X-Request-Start'):
+        self.app = app
+        self.max_waiting = max_in_flight if max_waiting is None else max_waiting
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.request_start_key = request_start_header and \
+            'HTTP_%s' % request_start_header.upper().replace('-', '_')
+        self.in_flight = 0
+        self.waiting = 0
+        self.metrics = Metrics(('admitted', 'shed_full', 'shed_timeout',
+                                'shed_deadline'),
+                               ('in_flight', 'waiting'), ('queue',))
+        self._semaphore = gevent.lock.Semaphore(max_in_flight)
+
+    def __call__(self, environ, start_response):
+        now = time.time()
+        started = self._get_request_start(environ) or now
+        deadline = started + self.queue_timeout
+        environ['flask_gevent.deadline'] = deadline
+        if deadline <= now:
+            # Client has given up already, most likely
+            return self._shed('deadline', start_response)
+
+        if not self._semaphore.acquire(blocking=False):
+            if self.waiting >= self.max_waiting:
+                return self._shed('full', start_response)
+            self.waiting += 1
+            self.metrics.set('waiting', self.waiting)
+            try:
+                acquired = self._semaphore.acquire(timeout=deadline - now)
+            finally:
+                self.waiting -= 1
+                self.metrics.set('waiting', self.waiting)
+            if not acquired:
+                return self._shed('timeout', start_response)
+
+        self.metrics.observe('queue', max(0, time.time() - started))
+        self.metrics.inc('admitted')
+        self.in_flight += 1
+        self.metrics.set('in_flight', self.in_flight)
+        try:
+            # Slot is released when response is sent and iterable is closed
+            rv = self.app(environ, start_response)
+            if isinstance(rv, _FileWrapper):
+                # Not hidden by ClosingIterator, to be sent by sendfile
+                rv.callbacks.append(self._release)
+                return rv
+            return ClosingIterator(rv, self._release)
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self.metrics.set('in_flight', self.in_flight)
+        self._semaphore.release()
+
+    def _get_request_start(self, environ):
+        # Seconds, milliseconds or microseconds since epoch, "t=" is optional
+        value = environ.get(self.request_start_key) if self.request_start_key else None
+        if not value:
+            return None
+        try:
+            value = float(value.strip().lstrip('t='))
+        except ValueError:
+            return None
+        while value > 1e11:
+            value /= 1000
+        return value
+
+    def _shed(self, reason, start_response):
+        self.metrics.inc('shed_%s' % reason)
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'text/plain'),
+            ('Retry-After', str(self.retry_after)),
+            ('Connection', 'close'),
+        ])
+        return [b'Service Unavailable\n']
+
+    def status(self):
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'admitted': self.metrics.counters['admitted'],
+            'shed': {reason: self.metrics.counters['shed_%s' % reason]
+                     for reason in ('full', 'timeout', 'deadline')},
+        }
@@ -1,8 +1,9 @@
 from functools import wraps
+from time import time
 
 from flask import current_app
 from werkzeug.local import LocalProxy
-from gevent import Timeout
+from gevent import Timeout, getcurrent
 from gevent._util import _NONE
 
 
@@ -24,7 +25,7 @@ def with_timeout(seconds, warning=True, timeout_value=_NONE):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            timeout = Timeout.start_new(seconds, _one_shot=True)
+            timeout = Timeout.start_new(limit_timeout(seconds), _one_shot=True)
             try:
                 return func(*args, **kwargs)
             except Timeout as t:
@@ -44,4 +45,87 @@ def with_timeout(seconds, warning=True, timeout_value=_NONE):
 
 
 def repr_pool_status(pool):
+    if hasattr(pool, 'min_size'):
+        # Adaptive pool, size is current limit
+        return '%s/%s [%s..%s]' % (pool.free_count(), pool.size,
+                                   pool.min_size, pool.max_size)
     return '%s/%s' % (pool.free_count(), pool.size)
+
+
+def get_origin(greenlet=None):
+    # What spawned greenlet: endpoint, lifecycle job, etc, see set_origin
+    return getattr(getcurrent() if greenlet is None else greenlet,
+                   'spawn_origin', None)
+
+
+def set_origin(origin, greenlet=None):
+    (getcurrent() if greenlet is None else greenlet).spawn_origin = origin
+
+
+class RequestScope:
+    """
+    Deadline of request and greenlets spawned for it. Greenlets owned only
+    by abandoned request (deadline exceeded or killed) are killed on finish.
+    """
+    def __init__(self, deadline=None):
+        self.deadline = deadline  # time(), None - no deadline
+        self.greenlet = getcurrent()  # handling request
+        self.greenlets = []
+
+    def own(self, greenlet):
+        # Greenlet may be owned by several requests, e.g. bulk processor worker
+        owners = getattr(greenlet, 'request_owners', None)
+        if owners is None:
+            owners = greenlet.request_owners = set()
+        if self not in owners:
+            owners.add(self)
+            self.greenlets.append(greenlet)
+
+    def limit(self, seconds):
+        # Sets deadline if it's earlier than current
+        deadline = time() + seconds
+        if self.deadline is None or deadline < self.deadline:
+            self.deadline = deadline
+
+    def finish(self, abandoned=False):
+        for greenlet in self.greenlets:
+            greenlet.request_owners.discard(self)
+            if abandoned and not greenlet.request_owners and not greenlet.dead:
+                greenlet.kill(block=False)
+        self.greenlets = []
+        self.greenlet = None
+
+
+def get_request_scope(greenlet=None):
+    # Not started greenlet is false, so checking for None
+    return getattr(getcurrent() if greenlet is None else greenlet,
+                   'request_scope', None)
+
+
+def set_request_scope(scope, greenlet=None):
+    (getcurrent() if greenlet is None else greenlet).request_scope = scope
+
+
+def limit_timeout(timeout):
+    # Timeout limited by remaining time of current request,
+    # None or False timeout means no timeout
+    scope = get_request_scope()
+    if not scope or scope.deadline is None:
+        return timeout
+    remaining = max(0, scope.deadline - time())
+    if timeout is None or timeout is False:
+        return remaining
+    return min(timeout, remaining)
+
+
+def request_timeout(seconds):
+    # View decorator, limits request deadline
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            scope = get_request_scope()
+            if scope:
+                scope.limit(seconds)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
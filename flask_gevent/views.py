@@ -1,5 +1,10 @@
-from flask import current_app
+import json
 
+import gevent
+from flask import current_app, jsonify, request, Response
+
+from .helpers import EntityBulkProcessor
+from .metrics import render_prometheus
 from .utils import repr_pool_status
 
 
@@ -10,7 +15,100 @@ def get_app_status():
             in current_app.extensions['gevent'].pools.items()
         },
     }
+    if current_app.extensions['gevent'].monitor:
+        rv['monitor'] = current_app.extensions['gevent'].monitor.status()
+    if current_app.extensions['gevent'].collapse:
+        rv['collapse'] = current_app.extensions['gevent'].collapse.metrics.counters
+    breakers = {
+        processor.name: processor.breaker.status()
+        for processor in EntityBulkProcessor.instances if processor.breaker
+    }
+    if breakers:
+        rv['breakers'] = breakers
+    if current_app.extensions['gevent'].profiler:
+        rv['profiler'] = current_app.extensions['gevent'].profiler.status()
+    if current_app.extensions['gevent'].admission:
+        rv['admission'] = current_app.extensions['gevent'].admission.status()
     if 'sqlalchemy' in current_app.extensions:
-        rv['sqlalchemy'] = \
-            current_app.extensions['sqlalchemy'].db.session.bind.pool.status()
+        pool = current_app.extensions['sqlalchemy'].db.session.bind.pool
+        rv['sqlalchemy'] = pool.status()
+        if hasattr(pool, 'metrics'):
+            rv['sqlalchemy_checkout'] = pool.metrics.as_dict()
     return rv
+
+
+def _get_metrics():
+    monitor = current_app.extensions['gevent'].monitor
+    db_pool = 'sqlalchemy' in current_app.extensions and \
+        current_app.extensions['sqlalchemy'].db.session.bind.pool
+    server = {
+        name: getattr(current_app.extensions['gevent'], name).metrics
+        for name in ('admission', 'collapse')
+        if getattr(current_app.extensions['gevent'], name)
+    }
+    return {
+        'hub': {'main': monitor.metrics} if monitor else {},
+        'db': {'default': db_pool.metrics} if hasattr(db_pool, 'metrics') else {},
+        'server': server,
+        'pools': {
+            name: pool.metrics for name, pool
+            in current_app.extensions['gevent'].pools.items()
+            if hasattr(pool, 'metrics')
+        },
+        'processors': {
+            processor.name: processor.metrics
+            for processor in EntityBulkProcessor.instances
+        },
+        'breakers': {
+            processor.name: processor.breaker.metrics
+            for processor in EntityBulkProcessor.instances if processor.breaker
+        },
+        'jobs': {
+            job.name: job.metrics
+            for job in current_app.extensions['gevent'].lifecycle.scheduled
+        },
+    }
+
+
+def get_app_metrics():
+    return {
+        group: {name: metrics.as_dict() for name, metrics in items.items()}
+        for group, items in _get_metrics().items()
+    }
+
+
+def metrics_view():
+    # Prometheus text format, or JSON with ?format=json
+    if request.args.get('format') == 'json':
+        return jsonify(get_app_metrics())
+    metrics = _get_metrics()
+    return Response(
+        render_prometheus('flask_gevent_hub', 'hub', metrics['hub'])
+        + render_prometheus('flask_gevent_server', 'server', metrics['server'])
+        + render_prometheus('flask_gevent_db', 'engine', metrics['db'])
+        + render_prometheus('flask_gevent_pool', 'pool', metrics['pools'])
+        + render_prometheus('flask_gevent_processor', 'processor',
+                            metrics['processors'])
+        + render_prometheus('flask_gevent_breaker', 'processor', metrics['breakers'])
+        + render_prometheus('flask_gevent_job', 'job', metrics['jobs']),
+        mimetype='text/plain; version=0.0.4',
+    )
+
+
+def profile_view():
+    # Profiles for ?seconds=10, returns collapsed stacks,
+    # or speedscope JSON with ?format=speedscope, ?interval is sampling seconds
+    profiler = current_app.extensions['gevent'].profiler
+    if not profiler:
+        return Response('Profiler is not enabled, see GEVENT_PROFILER\n', 404,
+                        mimetype='text/plain')
+    if profiler.running:
+        return Response('Profiler is running already\n', 409, mimetype='text/plain')
+    profiler.start(request.args.get('interval', type=float))
+    try:
+        gevent.sleep(request.args.get('seconds', 10, type=float))
+    finally:
+        profiler.stop()
+    if request.args.get('format') == 'speedscope':
+        return Response(json.dumps(profiler.speedscope()), mimetype='application/json')
+    return Response(profiler.collapsed(), mimetype='text/plain')
@@ -23,6 +23,6 @@ setup(
     author_email='vgavro@gmail.com',
     url='http://github.com/vgavro/flask-gevent',
     keywords='',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires=requires,
 )
@@ -0,0 +1,24 @@
+import pytest
+from flask import Flask
+
+from flask_gevent import Gevent
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    Gevent(app)
+    return app
+
+
+@pytest.fixture(autouse=True)
+def app_context(app):
+    # Pool greenlets are spawned in app context of spawning greenlet
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def spawn(app):
+    # Spawns greenlet in app context, as plain gevent.spawn has none
+    return app.extensions['gevent'].spawn
@@ -0,0 +1,80 @@
+import types
+
+import pytest
+from flask import Flask
+
+from flask_gevent import Gevent, Pool
+from flask_gevent.helpers import SqlAlchemyEntityBulkProcessor
+
+flask_sqlalchemy = pytest.importorskip('flask_sqlalchemy')
+
+
+@pytest.fixture
+def db():
+    return flask_sqlalchemy.SQLAlchemy()
+
+
+@pytest.fixture
+def Item(db):
+    class Item(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String, unique=True)
+    return Item
+
+
+@pytest.fixture
+def app(tmp_path, db, Item):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (tmp_path / 'test.db')
+    db.init_app(app)
+    Gevent(app)
+    # Extension is looked up as in Flask-SQLAlchemy 2
+    app.extensions['sqlalchemy'] = types.SimpleNamespace(db=db)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def create_processor(Item, **kwargs):
+    # Item names of 5 and 6 are not unique, so chunk of them fails
+    return SqlAlchemyEntityBulkProcessor(
+        Pool(10), Item, commit=True, chunk_size=4,
+        worker=lambda id: Item(id=id, name='dup' if id in (5, 6) else str(id)),
+        **kwargs)
+
+
+@pytest.mark.parametrize('upsert', [False, True])
+def test_commit_falls_back_by_row(db, Item, upsert):
+    processor = create_processor(Item, upsert=upsert)
+    data, errors = processor(*range(1, 9), join=True)
+
+    # Values are usable after commit, even ones not committed
+    assert {id: value.name for id, value in data.items()} == \
+        {id: 'dup' if id in (5, 6) else str(id) for id in range(1, 9)}
+    assert sorted(item.id for item in Item.query) == [1, 2, 3, 4, 5, 7, 8]
+    assert processor.metrics.counters['commits'] == 1 + 3
+    assert processor.metrics.counters['commit_fallbacks'] == 1
+    assert processor.metrics.counters['commit_errors'] == 1
+
+
+def test_commit_is_not_visible_to_caller_session(db, Item):
+    processor = create_processor(Item)
+    # Not flushed, as SQLite locks database for write of other session
+    with db.session.no_autoflush:
+        db.session.add(Item(id=100, name='caller'))
+        data, errors = processor(1, join=True)
+    # Own session is used for commit, caller transaction is not committed
+    assert data[1] not in db.session
+    db.session.rollback()
+    assert sorted(item.id for item in Item.query) == [1]
+
+
+def test_getter_finds_buffered_and_committed(db, Item):
+    processor = create_processor(Item, commit_wait=1)
+    processor(1, 2, join=True)
+    assert processor(1, 2, 3, spawn=False)[0].keys() == {1, 2}
+    assert processor.metrics.counters['hits'] == 2
+
+    processor = create_processor(Item, load_only=['name'])
+    data, errors = processor(1, 2, spawn=False)
+    assert {id: value.name for id, value in data.items()} == {1: '1', 2: '2'}
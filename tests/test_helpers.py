@@ -0,0 +1,303 @@
+import gevent
+import pytest
+from gevent.event import Event
+
+from flask_gevent import Pool
+from flask_gevent.helpers import (EntityBulkProcessor, CacheEntityBulkProcessor,
+                                  CircuitBreaker, CircuitOpenError, LocalCache,
+                                  LockedFactoryDict)
+
+
+class Processor(EntityBulkProcessor):
+    def __init__(self, pool, data=None, **kwargs):
+        self.data = {} if data is None else data
+        self.calls = []
+        super().__init__(pool, **kwargs)
+
+    def getter(self, entity_ids):
+        return {id: self.data[id] for id in entity_ids if id in self.data}
+
+    def on_value(self, entity_id, value):
+        self.data[entity_id] = value
+
+    def on_exception(self, entity_id, exc):
+        pass
+
+    def _worker(self, entity_id):
+        self.calls.append(entity_id)
+        gevent.sleep(0.01)
+        return entity_id * 10
+
+    def _batch_worker(self, entity_ids):
+        self.calls.append(sorted(entity_ids))
+        return {id: id * 10 for id in entity_ids}
+
+
+class Leases:
+    # Held by other process for first attempts
+    def __init__(self, busy=0):
+        self.busy = busy
+        self.released = []
+
+    def acquire(self, key, ttl):
+        self.busy -= 1
+        return self.busy < 0
+
+    def release(self, key):
+        self.released.append(key)
+
+
+def test_breaker_opens_and_closes_by_probe():
+    breaker = CircuitBreaker(min_runs=2, open_timeout=0.05, probes=1)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.done(True)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    gevent.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    # Only one probe is allowed until it's finished
+    assert not breaker.allow()
+    breaker.done(False)
+    assert breaker.state == 'closed'
+
+
+def test_breaker_probe_failure_opens_again():
+    breaker = CircuitBreaker(min_runs=1, open_timeout=0.05)
+    breaker.done(True)
+    gevent.sleep(0.06)
+    assert breaker.allow()
+    breaker.done(True)
+    assert breaker.state == 'open'
+
+
+def test_breaker_not_finished_probe_is_released():
+    breaker = CircuitBreaker(min_runs=1, open_timeout=0.05)
+    breaker.done(True)
+    gevent.sleep(0.06)
+    assert breaker.allow()
+    breaker.done(None)
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+
+
+def test_processor_spawns_worker_once_for_concurrent_calls(spawn):
+    processor = Processor(Pool(10), data={1: 'found'})
+    results = [spawn(processor, 1, 2, 3, join=True) for _ in range(3)]
+    gevent.joinall(results, raise_error=True)
+
+    for greenlet in results:
+        assert greenlet.value == ({1: 'found', 2: 20, 3: 30}, {})
+    assert sorted(processor.calls) == [2, 3]
+    assert processor.metrics.counters['spawns'] == 2
+    assert not processor.workers
+
+
+def test_processor_unique_names():
+    class Named(Processor):
+        pass
+
+    pool = Pool(1)
+    processors = [Named(pool), Named(pool),
+                  Processor(pool, name='x'), Processor(pool, name='x')]
+    assert [p.name for p in processors] == ['Named', 'Named_2', 'x', 'x_2']
+
+
+def test_processor_iter_without_join_timeout():
+    processor = Processor(Pool(10), data={1: 'found'})
+    assert dict(processor.iter(1, 2, 3, join_timeout=False)) == \
+        {1: 'found', 2: 20, 3: 30}
+
+
+def test_processor_iter_join_timeout():
+    pool = Pool(10)
+    processor = Processor(pool, worker=lambda id: gevent.sleep(1))
+    with pytest.raises(RuntimeError):
+        list(processor.iter(1, join_timeout=0.01))
+    assert processor.metrics.counters['join_timeouts'] == 1
+    pool.kill()
+
+
+def test_processor_batch():
+    processor = Processor(Pool(10), batch_size=2, batch_wait=0.01)
+    data, errors = processor(1, 2, 3, join=True)
+    assert data == {1: 10, 2: 20, 3: 30}
+    assert sorted(len(batch) for batch in processor.calls) == [1, 2]
+    assert not processor.workers
+
+
+def test_processor_breaker_fails_fast():
+    breaker = CircuitBreaker(min_runs=1)
+    breaker._open()
+    processor = Processor(Pool(10), breaker=breaker)
+    data, errors = processor(1, join=True)
+    assert isinstance(errors[1], CircuitOpenError)
+    assert not processor.calls
+
+
+def test_processor_spawned_meanwhile_releases_probe(spawn):
+    breaker = CircuitBreaker(min_runs=1, open_timeout=0.05, probes=2)
+    breaker.done(True)
+    gevent.sleep(0.06)
+    pool = Pool(2)
+    processor = Processor(pool, breaker=breaker)
+    event = Event()
+    blockers = [pool.spawn(event.wait) for _ in range(2)]
+    # Both callers are allowed probe and wait for pool, second one finds
+    # worker spawned by first when both slots are freed at once
+    results = [spawn(processor, 1, join=True) for _ in range(2)]
+    gevent.sleep(0)
+    event.set()
+    gevent.joinall(results + blockers, raise_error=True)
+
+    assert processor.calls == [1]
+    assert breaker._probing == 0
+    assert breaker._probed == 1
+    assert breaker.state == 'half_open'
+
+
+def test_leased_worker_uses_value_of_lease_holder(spawn):
+    leases = Leases(busy=2)
+    processor = Processor(Pool(10), leases=leases, lease_poll=0.01, name='leased')
+
+    def held_by_other_process():
+        gevent.sleep(0.005)
+        processor.data[1] = 'other'
+
+    spawn(held_by_other_process)
+    data, errors = processor(1, join=True)
+    assert data == {1: 'other'}
+    assert not processor.calls
+    assert processor.metrics.counters['lease_hits'] == 1
+    assert leases.released == ['leased:1']
+    assert not processor.workers
+
+
+def test_leased_worker_getter_error_fails_probe():
+    breaker = CircuitBreaker(min_runs=1, open_timeout=0.05)
+    breaker.done(True)
+    gevent.sleep(0.06)
+
+    class FailingProcessor(Processor):
+        def getter(self, entity_ids):
+            if self.workers:
+                raise ValueError('getter')
+            return {}
+
+    processor = FailingProcessor(Pool(10), leases=Leases(busy=1), lease_poll=0.01,
+                                 breaker=breaker)
+    processor(1, join=True, join_raise=False)
+    assert breaker.state == 'open'
+    assert breaker._probing == 0
+    assert not processor.workers
+
+
+class Cache(LocalCache):
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.writes = []
+
+    def set_many(self, mapping, timeout=None):
+        self.writes.append(dict(mapping))
+        super().set_many(mapping, timeout)
+
+
+class CacheProcessor(CacheEntityBulkProcessor):
+    calls = None
+
+    def _worker(self, entity_id):
+        self.calls.append(entity_id)
+        return entity_id * 10
+
+
+def test_cache_processor_buffers_writes():
+    cache = Cache(10)
+    processor = CacheProcessor(Pool(10), cache, 60, 1, cache_write_wait=1)
+    processor.calls = []
+    processor(1, 2)
+    gevent.sleep(0.01)
+    # Buffered values are found before they are written
+    assert not cache.writes
+    assert processor(1, 2, spawn=False) == ({1: 10, 2: 20}, {})
+
+    processor.flush()
+    assert cache.writes == [{1: 10, 2: 20}]
+    assert processor(1, 2, spawn=False) == ({1: 10, 2: 20}, {})
+    assert sorted(processor.calls) == [1, 2]
+
+
+def test_cache_processor_refreshes_stale():
+    cache = Cache(10)
+    processor = CacheProcessor(Pool(10), cache, 60, 1, cache_write_wait=0,
+                               cache_soft_timeout=-1)
+    processor.calls = []
+    processor(1, join=True)
+    # Stale value is returned, while it's refreshed in background
+    assert processor(1) == ({1: 10}, {})
+    gevent.sleep(0.01)
+    assert processor.calls == [1, 1]
+
+
+def test_locked_factory_dict_calls_factory_once():
+    calls = []
+
+    def factory(key):
+        calls.append(key)
+        gevent.sleep(0.01)
+        return key.upper()
+
+    data = LockedFactoryDict(factory)
+    results = [gevent.spawn(data.__getitem__, 'a') for _ in range(3)]
+    gevent.joinall(results, raise_error=True)
+    assert [greenlet.value for greenlet in results] == ['A'] * 3
+    assert calls == ['a']
+    assert data['a'] == 'A'
+    assert calls == ['a']
+
+
+def test_locked_factory_dict_error_ttl():
+    calls = []
+
+    def factory(key):
+        calls.append(key)
+        raise ValueError(key)
+
+    data = LockedFactoryDict(factory, error_ttl=0.05)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            data['a']
+    assert calls == ['a']
+    gevent.sleep(0.06)
+    with pytest.raises(ValueError):
+        data['a']
+    assert calls == ['a', 'a']
+
+
+def test_locked_factory_dict_interrupted_factory():
+    data = LockedFactoryDict(lambda key: gevent.sleep(1))
+    creator = gevent.spawn(data.__getitem__, 'a')
+    gevent.sleep(0)
+    reader = gevent.spawn(data.get, 'a', 'default')
+    gevent.sleep(0)
+    creator.kill()
+    # Reader is not killed with GreenletExit of creator
+    assert reader.get() == 'default'
+    assert 'a' not in data
+
+
+def test_locked_factory_dict_maxsize_and_ttl():
+    evicted = []
+    data = LockedFactoryDict(str.upper, maxsize=2, ttl=0.05,
+                             on_evict=lambda key, value: evicted.append(key))
+    for key in 'aba':
+        data[key]
+    data['c']
+    # Least recently used is evicted
+    assert evicted == ['b']
+    assert list(data.data) == ['a', 'c']
+
+    gevent.sleep(0.06)
+    assert 'a' not in data
+    assert evicted == ['b', 'a']
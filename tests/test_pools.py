@@ -0,0 +1,143 @@
+import gevent
+import pytest
+from gevent.event import Event
+from gevent.pool import PoolFull
+
+from flask_gevent import Pool
+from flask_gevent.pools import PriorityPool, AdaptivePool
+
+
+def run_in_order(spawn, pool, spawns):
+    # Spawns (priority, key) while pool is full, returns order they are run in
+    order, event = [], Event()
+    blocker = pool.spawn(event.wait)
+    spawners = []
+    for priority, key in spawns:
+        spawners.append(spawn(pool.spawn_with, priority, key,
+                              order.append, (priority, key)))
+        gevent.sleep(0)
+    event.set()
+    gevent.joinall(spawners, raise_error=True)
+    pool.join()
+    blocker.get()
+    return order
+
+
+def test_priority_pool_priority(spawn):
+    pool = PriorityPool(1)
+    order = run_in_order(spawn, pool, [('background', 'a'), ('default', 'a'),
+                                       ('interactive', 'a')])
+    assert order == [('interactive', 'a'), ('default', 'a'), ('background', 'a')]
+
+
+def test_priority_pool_fair_keys(spawn):
+    pool = PriorityPool(1)
+    order = run_in_order(spawn, pool, [(None, 'a')] * 3 + [(None, 'b')])
+    # Key b is not waiting for all spawns of key a
+    assert order.index((None, 'b')) == 1
+
+
+def test_priority_pool_weights(spawn):
+    pool = PriorityPool(1, weights={'a': 2})
+    order = run_in_order(spawn, pool, [(None, 'a')] * 4 + [(None, 'b')] * 2)
+    assert [key for priority, key in order] == ['a', 'a', 'b', 'a', 'a', 'b']
+
+
+def test_priority_pool_max_waiting(spawn):
+    pool = PriorityPool(1, max_waiting=1)
+    event = Event()
+    pool.spawn(event.wait)
+    waiting = spawn(pool.spawn, gevent.sleep, 0)
+    gevent.sleep(0)
+    with pytest.raises(PoolFull):
+        pool.spawn(gevent.sleep, 0)
+    assert pool.rejected == 1
+    event.set()
+    waiting.get()
+    pool.join()
+    assert pool.waiting == 0
+
+
+def test_priority_pool_reject_lowest(spawn):
+    pool = PriorityPool(1, max_waiting=1, reject='lowest')
+    event = Event()
+    pool.spawn(event.wait)
+    background = spawn(pool.spawn_with, 'background', None,
+                       gevent.sleep, 0)
+    gevent.sleep(0)
+    interactive = spawn(pool.spawn_with, 'interactive', None,
+                        gevent.sleep, 0)
+    gevent.sleep(0)
+    with pytest.raises(PoolFull):
+        background.get()
+    event.set()
+    interactive.get()
+    pool.join()
+    assert pool.rejected == 1
+    # Slot is released by all greenlets
+    assert pool.free_count() == 1
+
+
+def test_priority_pool_waiter_timeout_passes_slot():
+    pool = PriorityPool(1)
+    event = Event()
+    pool.spawn(event.wait)
+    with pytest.raises(PoolFull):
+        pool.add(pool.greenlet_class(gevent.sleep, 0), timeout=0.01)
+    assert pool.waiting == 0
+    event.set()
+    pool.join()
+    assert pool.free_count() == 1
+
+
+def test_adaptive_pool_limit(spawn):
+    pool = AdaptivePool(2, min_size=1, max_size=4, algorithm='aimd',
+                        backoff=0.5)
+    event = Event()
+    for _ in range(2):
+        pool.spawn(event.wait)
+    waiting = spawn(pool.spawn, gevent.sleep, 0)
+    gevent.sleep(0)
+    assert pool.free_count() == 0
+
+    # Waiter is woken by increased limit
+    pool._set_limit(3)
+    waiting.get()
+    assert pool.size == 3
+    event.set()
+    pool.join()
+
+    pool.spawn(lambda: ValueError()).join()
+    assert pool.size == 1
+    assert pool.metrics.gauges['limit'] == 1
+
+
+def test_adaptive_pool_limit_decrease_keeps_running():
+    pool = AdaptivePool(2, min_size=1, algorithm='aimd')
+    event = Event()
+    greenlets = [pool.spawn(event.wait) for _ in range(2)]
+    pool._set_limit(1)
+    assert pool.free_count() == 0
+    event.set()
+    gevent.joinall(greenlets)
+    # Slots are released, limit is increased by successful greenlets again
+    assert pool._semaphore.used == 0
+    assert pool.free_count() == pool.size
+
+
+def test_pool_metrics_wait():
+    pool = Pool(1)
+    pool.spawn(gevent.sleep, 0.05)
+    pool.wait_available()
+    pool.spawn(gevent.sleep, 0).join()
+    histogram = pool.metrics.as_dict()['histograms']['wait']
+    assert histogram['count'] == 2
+    assert histogram['sum'] >= 0.05
+
+    # Wait is not added to spawn after switching to other greenlets
+    pool.wait_available()
+    gevent.sleep(0.05)
+    pool.spawn(gevent.sleep, 0).join()
+    histogram = pool.metrics.as_dict()['histograms']['wait']
+    assert histogram['count'] == 3
+    assert histogram['sum'] < 0.1